@@ -0,0 +1,49 @@
+from datetime import timedelta
+from typing import Optional
+from coordinate import GarminSegment
+from video import GoProVideo
+
+
+def get_garmin_time_shift(
+    video: GoProVideo,
+    garmin_segment: GarminSegment,
+    lap_time: timedelta,
+    left_search_bound: timedelta,
+    right_search_bound: timedelta,
+) -> Optional[timedelta]:
+    """
+    Find the first Garmin lap inside the search window around the lap button
+    press in the video and return how far the Garmin clock is ahead of the
+    camera clock, or None if no lap falls inside the search window.
+    """
+    print(f"Video start:   {str(video.get_start_time())}")
+    print(f"Video end:     {str(video.get_end_time())}")
+    print(f"Garmin start:  {str(garmin_segment.get_start_time())}")
+    print(f"Garmin end:    {str(garmin_segment.get_end_time())}\n")
+
+    left_search, right_search = (
+        video.get_start_time() + lap_time + left_search_bound,
+        video.get_start_time() + lap_time + right_search_bound,
+    )
+
+    print("Available lap timestamps:\n")
+    print(
+        "\n".join([str(lap.start_time) for lap in garmin_segment.get_manual_laps()])
+        + "\n"
+    )
+    print(f"Searching for Garmin lap time between {left_search} and {right_search}.")
+    garmin_lap = garmin_segment.get_first_lap(left_search, right_search)
+
+    if garmin_lap is None:
+        print("Could not find lap coordinate. There must be one to align video.")
+        return None
+
+    print(f"Found Garmin lap time at {garmin_lap.start_time}.\n")
+
+    garmin_lap_time = garmin_lap.start_time
+    go_pro_lap_time = video.get_start_time() + lap_time
+
+    garmin_time_shift = garmin_lap_time - go_pro_lap_time
+    print(f"Garmin time shift: {garmin_time_shift}")
+
+    return garmin_time_shift
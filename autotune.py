@@ -0,0 +1,315 @@
+"""
+Benchmark of encoder profiles on a sample of the actual ride.
+
+A short window of the source video is cut, scaled to the first output of the
+render config and stored losslessly, so every profile encodes exactly the same
+frames. Each profile then encodes the sample, and its encode speed, bitrate
+and quality against the sample (PSNR and SSIM, measured by ffmpeg) are
+reported. The fastest profile that meets the targets is recommended:
+
+    python autotune.py --video-files GX*.MP4 --render-config-file configs/4k-map-and-stats.json \
+        --max-bitrate-in-mbps 40 --min-ssim 0.98
+
+Profiles are the built-in ones and the ones under "encoderProfiles" in the
+render config. The recommended one is set as "encoderProfile".
+"""
+
+import argparse
+import os
+import re
+import tempfile
+import time
+from datetime import timedelta
+from typing import Any, Dict, List, Optional
+
+import ffmpeg
+
+from config import (
+    get_encoder_options,
+    get_encoder_profiles,
+    get_render_outputs,
+    load_render_config,
+    RenderOutput,
+)
+from resources import AUTO, get_num_cores
+from video import GoProVideo
+
+
+# lossless, and fast to decode so decoding barely counts towards encode speed
+SAMPLE_ENCODER_OPTIONS = {"vcodec": "libx264", "preset": "ultrafast", "qp": 0}
+
+
+class ProfileResult:
+    def __init__(
+        self,
+        name: str,
+        encode_fps: float,
+        bitrate: float,
+        psnr: float,
+        ssim: float,
+    ) -> None:
+        self.name = name
+        self.encode_fps = encode_fps
+        self.bitrate = bitrate
+        self.psnr = psnr
+        self.ssim = ssim
+
+    def meets(
+        self,
+        max_bitrate: Optional[float] = None,
+        min_psnr: Optional[float] = None,
+        min_ssim: Optional[float] = None,
+    ) -> bool:
+        return (
+            (max_bitrate is None or self.bitrate <= max_bitrate)
+            and (min_psnr is None or self.psnr >= min_psnr)
+            and (min_ssim is None or self.ssim >= min_ssim)
+        )
+
+    def __str__(self) -> str:
+        return (
+            f"{self.name:<20} {self.encode_fps:>8.1f} fps "
+            f"{self.bitrate / 1e6:>8.2f} Mbps {self.psnr:>7.2f} dB PSNR "
+            f"{self.ssim:>7.4f} SSIM"
+        )
+
+
+def write_sample(
+    video: GoProVideo,
+    output: RenderOutput,
+    sample_offset: timedelta,
+    sample_length: timedelta,
+    path: str,
+) -> None:
+    from render import VideoRenderer, fit_to_resolution
+
+    renderer = VideoRenderer(
+        video=video,
+        video_length=sample_length,
+        video_offset=sample_offset,
+        outputs=[output],
+        num_threads=get_num_cores(),
+        audio="none",
+    )
+    start = sample_offset.total_seconds()
+    end = start + sample_length.total_seconds()
+
+    inputs = renderer.get_chapter_inputs(start, end)
+    stream = (
+        ffmpeg.concat(*[input.video for input in inputs])
+        .trim(start=0, end=end - start)
+        .setpts("PTS-STARTPTS")
+    )
+    ffmpeg.output(
+        fit_to_resolution(stream, video.get_resolution(), output),
+        path,
+        **SAMPLE_ENCODER_OPTIONS,
+    ).run(overwrite_output=True, quiet=True)
+
+
+def _measure(filter_name: str, pattern: str, path: str, sample_path: str) -> float:
+    _, stderr = (
+        ffmpeg.filter(
+            [ffmpeg.input(path).video, ffmpeg.input(sample_path).video], filter_name
+        )
+        .output("-", f="null")
+        .run(capture_stderr=True)
+    )
+    return float(re.findall(pattern, stderr.decode())[-1])
+
+
+def measure_psnr(path: str, sample_path: str) -> float:
+    return _measure("psnr", r"average:([\d.]+|inf)", path, sample_path)
+
+
+def measure_ssim(path: str, sample_path: str) -> float:
+    return _measure("ssim", r"All:([\d.]+)", path, sample_path)
+
+
+def benchmark_profile(
+    name: str,
+    profile: Dict[str, Any],
+    sample_path: str,
+    sample_length: timedelta,
+    num_frames: int,
+    num_threads: int,
+    work_dir: str,
+) -> ProfileResult:
+    path = os.path.join(work_dir, f"{name}.mp4")
+    cmd = ffmpeg.input(sample_path).video.output(
+        path, threads=num_threads, **get_encoder_options(profile)
+    )
+
+    encode_start_time = time.time()
+    cmd.run(overwrite_output=True, quiet=True)
+    encode_seconds = time.time() - encode_start_time
+
+    return ProfileResult(
+        name=name,
+        encode_fps=num_frames / encode_seconds,
+        bitrate=os.path.getsize(path) * 8 / sample_length.total_seconds(),
+        psnr=measure_psnr(path, sample_path),
+        ssim=measure_ssim(path, sample_path),
+    )
+
+
+def autotune(
+    video: GoProVideo,
+    render_config: Dict[str, Any],
+    profile_names: Optional[List[str]] = None,
+    sample_offset: Optional[timedelta] = None,
+    sample_length: timedelta = timedelta(seconds=10),
+) -> List[ProfileResult]:
+    """Benchmark encoder profiles, every profile of the render config by default."""
+    profiles = get_encoder_profiles(render_config)
+    if profile_names is None:
+        profile_names = list(profiles)
+    for name in profile_names:
+        assert name in profiles, f"Unknown encoder profile {name}"
+
+    sample_length = min(sample_length, video.get_duration())
+    if sample_offset is None:
+        sample_offset = (video.get_duration() - sample_length) / 2
+
+    num_threads = render_config["videoNumberOfThreads"]
+    if num_threads == AUTO:
+        num_threads = get_num_cores()
+
+    output = get_render_outputs(render_config, "sample.mp4", video.get_resolution())[0]
+    num_frames = round(sample_length.total_seconds() * video.get_fps())
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        sample_path = os.path.join(work_dir, "sample.mkv")
+        print(
+            f"Cutting a {sample_length} sample at {sample_offset}, "
+            f"{output.resolution[0]}x{output.resolution[1]}..."
+        )
+        write_sample(video, output, sample_offset, sample_length, sample_path)
+
+        for name in profile_names:
+            print(f"Encoding with {name}...")
+            try:
+                result = benchmark_profile(
+                    name,
+                    profiles[name],
+                    sample_path,
+                    sample_length,
+                    num_frames,
+                    num_threads,
+                    work_dir,
+                )
+            except ffmpeg.Error:
+                # e.g. ffmpeg was built without the encoder of this profile
+                print(f"Skipping {name}, ffmpeg could not encode with it.")
+                continue
+            print(result)
+            results.append(result)
+
+    return results
+
+
+def choose_profile(
+    results: List[ProfileResult],
+    max_bitrate: Optional[float] = None,
+    min_psnr: Optional[float] = None,
+    min_ssim: Optional[float] = None,
+) -> Optional[ProfileResult]:
+    """The fastest profile that meets every target, if any does."""
+    candidates = [
+        result for result in results if result.meets(max_bitrate, min_psnr, min_ssim)
+    ]
+    if len(candidates) == 0:
+        return None
+    return max(candidates, key=lambda result: result.encode_fps)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark encoder profiles on a sample of the ride"
+    )
+    parser.add_argument(
+        "--video-files",
+        help="Video files of ride",
+        required=True,
+        type=str,
+        nargs="*",
+    )
+    parser.add_argument(
+        "--render-config-file",
+        help="Render config with the outputs and encoder profiles to benchmark",
+        required=True,
+        type=str,
+    )
+    parser.add_argument(
+        "--profiles",
+        help="Names of the encoder profiles to benchmark. Benchmarks all of them if omitted",
+        type=str,
+        nargs="*",
+        default=None,
+    )
+    parser.add_argument(
+        "--sample-at-in-secs",
+        help="How many seconds into the input video the sample should start. Defaults to the middle of the video",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--sample-length-in-secs",
+        help="How many seconds the sample should last",
+        type=float,
+        default=10.0,
+    )
+    parser.add_argument(
+        "--max-bitrate-in-mbps",
+        help="Largest acceptable output bitrate",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--min-psnr",
+        help="Lowest acceptable PSNR in dB",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--min-ssim",
+        help="Lowest acceptable SSIM, from 0 to 1",
+        type=float,
+        default=None,
+    )
+    args = vars(parser.parse_args())
+
+    results = autotune(
+        GoProVideo(args["video_files"]),
+        load_render_config(args["render_config_file"]),
+        profile_names=args["profiles"],
+        sample_offset=(
+            None
+            if args["sample_at_in_secs"] is None
+            else timedelta(seconds=args["sample_at_in_secs"])
+        ),
+        sample_length=timedelta(seconds=args["sample_length_in_secs"]),
+    )
+
+    print("\nResults, fastest first:")
+    for result in sorted(results, key=lambda result: -result.encode_fps):
+        print(result)
+
+    best = choose_profile(
+        results,
+        max_bitrate=(
+            None
+            if args["max_bitrate_in_mbps"] is None
+            else args["max_bitrate_in_mbps"] * 1e6
+        ),
+        min_psnr=args["min_psnr"],
+        min_ssim=args["min_ssim"],
+    )
+    if best is None:
+        print("\nNo profile meets the targets.")
+    else:
+        print(
+            "\nFastest profile meeting the targets: "
+            f'set "encoderProfile": "{best.name}"'
+        )
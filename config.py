@@ -0,0 +1,240 @@
+import json
+import os
+from copy import deepcopy
+from typing import Any, Dict, List, Optional, Tuple
+
+
+DEFAULT_ENCODER_OPTIONS = {"preset": "ultrafast"}
+PREVIEW_ENCODER_OPTIONS = {"vcodec": "libx264", "preset": "ultrafast", "crf": 30}
+# ffmpeg option for every encoder profile key, extra options go under "options"
+ENCODER_PROFILE_KEYS = {
+    "codec": "vcodec",
+    "preset": "preset",
+    "crf": "crf",
+    "tune": "tune",
+    "pixFmt": "pix_fmt",
+    "gop": "g",
+}
+ENCODER_PROFILES = {
+    "x264-ultrafast": {"codec": "libx264", "preset": "ultrafast", "pixFmt": "yuv420p"},
+    "x264-veryfast": {
+        "codec": "libx264",
+        "preset": "veryfast",
+        "crf": 23,
+        "pixFmt": "yuv420p",
+    },
+    "x264-medium": {
+        "codec": "libx264",
+        "preset": "medium",
+        "crf": 21,
+        "pixFmt": "yuv420p",
+    },
+    "x265-fast": {"codec": "libx265", "preset": "fast", "crf": 26, "pixFmt": "yuv420p"},
+    "x265-medium": {
+        "codec": "libx265",
+        "preset": "medium",
+        "crf": 24,
+        "pixFmt": "yuv420p",
+    },
+    "svtav1-10": {"codec": "libsvtav1", "preset": 10, "crf": 35, "pixFmt": "yuv420p"},
+    "svtav1-6": {"codec": "libsvtav1", "preset": 6, "crf": 32, "pixFmt": "yuv420p"},
+}
+PANEL_CONFIG_KEYS = ["panelWidth", "stats", "map", "elevation"]
+
+
+class RenderOutput:
+    def __init__(
+        self,
+        name: Optional[str],
+        filepath: str,
+        resolution: Tuple[int, int],
+        fit: str,
+        panel_config: Dict[str, Any],
+        encoder_options: Dict[str, Any],
+    ) -> None:
+        assert fit in ["scale", "crop"]
+        self.name = name
+        self.filepath = filepath
+        self.resolution = resolution
+        self.fit = fit
+        self.panel_config = panel_config
+        self.encoder_options = encoder_options
+        self.panel_folder: Optional[str] = None
+
+    def get_panel_key(self) -> str:
+        """Outputs with the same key can share one set of rendered panels."""
+        return json.dumps([self.resolution, self.panel_config], sort_keys=True)
+
+
+def load_render_config(path: str) -> Dict[str, Any]:
+    with open(path) as render_config_file:
+        return json.loads(render_config_file.read())
+
+
+def _merge(base: Dict[str, Any], overrides: Dict[str, Any]) -> Dict[str, Any]:
+    merged = deepcopy(base)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def get_encoder_profiles(render_config: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """The built-in encoder profiles along with the ones of the render config."""
+    return {**ENCODER_PROFILES, **render_config.get("encoderProfiles", {})}
+
+
+def get_encoder_options(profile: Dict[str, Any]) -> Dict[str, Any]:
+    unknown_keys = set(profile) - set(ENCODER_PROFILE_KEYS) - {"options"}
+    assert len(unknown_keys) == 0, f"Unknown encoder profile keys {unknown_keys}"
+    return {
+        **{
+            ENCODER_PROFILE_KEYS[key]: value
+            for key, value in profile.items()
+            if key in ENCODER_PROFILE_KEYS
+        },
+        **profile.get("options", {}),
+    }
+
+
+def get_render_outputs(
+    render_config: Dict[str, Any],
+    output_filepath: str,
+    source_resolution: Tuple[int, int],
+) -> List[RenderOutput]:
+    """
+    Outputs declared under "outputs" in the render config. Each one may set a
+    name (appended to the output path), resolution, fit ("scale" or "crop"),
+    panel layout overrides, an encoder profile and ffmpeg encoder options that
+    override the profile. Without "outputs" a single output at the source
+    resolution is rendered to the output path.
+    """
+    base_panel_config = {
+        key: render_config[key] for key in PANEL_CONFIG_KEYS if key in render_config
+    }
+    encoder_profiles = get_encoder_profiles(render_config)
+    output_configs = render_config.get("outputs", [{}])
+    root, extension = os.path.splitext(output_filepath)
+
+    outputs = []
+    for output_config in output_configs:
+        name = output_config.get("name")
+
+        encoder_options = DEFAULT_ENCODER_OPTIONS
+        encoder_profile = output_config.get(
+            "encoderProfile", render_config.get("encoderProfile")
+        )
+        if encoder_profile is not None:
+            assert (
+                encoder_profile in encoder_profiles
+            ), f"Unknown encoder profile {encoder_profile}"
+            encoder_options = get_encoder_options(encoder_profiles[encoder_profile])
+
+        outputs.append(
+            RenderOutput(
+                name=name,
+                filepath=output_filepath if name is None else f"{root}-{name}{extension}",
+                resolution=tuple(output_config.get("resolution", source_resolution)),
+                fit=output_config.get("fit", "scale"),
+                panel_config=_merge(base_panel_config, output_config.get("panel", {})),
+                encoder_options={
+                    **encoder_options,
+                    **output_config.get("encoder", {}),
+                },
+            )
+        )
+
+    assert len(set(output.filepath for output in outputs)) == len(
+        outputs
+    ), "Every output needs a unique name"
+
+    return outputs
+
+
+def assign_panel_folders(outputs: List[RenderOutput], panel_folder: str) -> List[RenderOutput]:
+    """
+    Give every output a panel folder, one per distinct panel size and layout.
+    Returns one representative output per folder, i.e. the panels to render.
+    """
+    folders: Dict[str, str] = {}
+    panels_to_render = []
+    for output in outputs:
+        key = output.get_panel_key()
+        if key not in folders:
+            folders[key] = (
+                panel_folder if len(folders) == 0 else f"{panel_folder}-{len(folders)}"
+            )
+            panels_to_render.append(output)
+        output.panel_folder = folders[key]
+    return panels_to_render
+
+
+def get_panel_renderer_options(panel_config: Dict[str, Any]) -> Dict[str, Any]:
+    options = dict(
+        panel_width=panel_config["panelWidth"],
+        map_height=panel_config["map"]["height"],
+        map_opacity=panel_config["map"]["opacity"],
+        map_marker_inner_size=panel_config["map"]["marker"]["innerSize"],
+        map_marker_inner_opacity=panel_config["map"]["marker"]["innerOpacity"],
+        map_marker_outer_size=panel_config["map"]["marker"]["outerSize"],
+        map_marker_outer_opacity=panel_config["map"]["marker"]["outerOpacity"],
+        stat_keys_and_labels=panel_config["stats"]["keysAndLabels"],
+        stats_x_position=panel_config["stats"]["xPosition"],
+        stats_y_range=panel_config["stats"]["yPositionRange"],
+        stat_label_y_position_delta=panel_config["stats"]["statToLabelYDistance"],
+        font_size=panel_config["stats"]["fontSize"],
+        label_font_size=panel_config["stats"]["labelFontSize"],
+        stats_opacity=panel_config["stats"]["opacity"],
+        line_width_scale=panel_config.get("lineWidthScale", 1.0),
+    )
+    if "elevation" in panel_config:
+        options.update(
+            elevation_height=panel_config["elevation"]["height"],
+            elevation_opacity=panel_config["elevation"]["opacity"],
+            elevation_cursor_size=panel_config["elevation"]["cursorSize"],
+            elevation_font_size=panel_config["elevation"]["fontSize"],
+        )
+    return options
+
+
+def scale_panel_config(panel_config: Dict[str, Any], scale: float) -> Dict[str, Any]:
+    """
+    Scale the absolute sizes in a panel config. Everything else is a fraction
+    of the output resolution and scales with it already.
+    """
+    scaled = deepcopy(panel_config)
+    for key in ["fontSize", "labelFontSize"]:
+        scaled["stats"][key] = panel_config["stats"][key] * scale
+    for key in ["innerSize", "outerSize"]:
+        scaled["map"]["marker"][key] = panel_config["map"]["marker"][key] * scale
+    if "elevation" in panel_config:
+        for key in ["cursorSize", "fontSize"]:
+            scaled["elevation"][key] = panel_config["elevation"][key] * scale
+    # the route and elevation strokes are in points too
+    scaled["lineWidthScale"] = panel_config.get("lineWidthScale", 1.0) * scale
+    return scaled
+
+
+def get_preview_outputs(outputs: List[RenderOutput], scale: float) -> List[RenderOutput]:
+    """
+    Scaled down copies of the outputs, written next to them with a -preview
+    suffix. Previews are always encoded with fast x264, whatever the profile.
+    """
+    preview_outputs = []
+    for output in outputs:
+        root, extension = os.path.splitext(output.filepath)
+        # most encoders need even dimensions
+        width, height = [max(2, round(size * scale / 2) * 2) for size in output.resolution]
+        preview_outputs.append(
+            RenderOutput(
+                name=output.name,
+                filepath=f"{root}-preview{extension}",
+                resolution=(width, height),
+                fit=output.fit,
+                panel_config=scale_panel_config(output.panel_config, scale),
+                encoder_options=PREVIEW_ENCODER_OPTIONS,
+            )
+        )
+    return preview_outputs
@@ -1,13 +1,24 @@
+import bisect
+import gc
 from datetime import datetime, timedelta, timezone
 import json
-from typing import List, Optional, Dict, Any, Tuple
+from typing import List, Optional, Dict, Any, Tuple, TYPE_CHECKING
 import geopy.distance
-import functools
-from garmin_fit_sdk import Decoder, Stream
+import math
+import os
+from xml.etree import ElementTree
 import subprocess
 import gpxpy
 import csv
 from copy import copy
+import numpy as np
+
+if TYPE_CHECKING:
+    from spatial import SpatialIndex
+
+# largest relative difference of the haversine distance to the geodesic one,
+# with some margin
+GEODESIC_TOLERANCE = 0.01
 
 
 class Coordinate:
@@ -53,6 +64,14 @@ class Coordinate:
             (self.latitude, self.longitude), (other.latitude, other.longitude)
         ).km
 
+    def _is_within_a_km(self, other: "Coordinate") -> bool:
+        distance = _haversine_distance(
+            self.latitude, self.longitude, other.latitude, other.longitude
+        )
+        if abs(distance - 1000) > 1000 * GEODESIC_TOLERANCE:
+            return distance < 1000
+        return Coordinate.distance(self, other) < 1
+
     @staticmethod
     def load_coordinates_from_video_file(video_file_path: str) -> List["Coordinate"]:
         output = subprocess.run(
@@ -83,12 +102,30 @@ class Coordinate:
 
 class GarminCoordinate(Coordinate):
     INT_TO_FLOAT_LAT_LONG_CONST = 11930465
+    RECORD_KEYS = (
+        "distance",
+        "temperature",
+        "altitude",
+        "heart_rate",
+        "speed",
+        "enhanced_speed",
+        "power",
+        "cadence",
+    )
+    DERIVED_METRIC_KEYS = (
+        "power_3s",
+        "power_10s",
+        "power_30s",
+        "normalized_power",
+        "gradient",
+        "vam",
+    )
 
     def __init__(
         self,
         timestamp: datetime,
-        distance: float,
-        temperature: int,
+        distance: Optional[float] = None,
+        temperature: Optional[int] = None,
         altitude: Optional[float] = None,
         heart_rate: Optional[int] = None,
         speed: Optional["Speed"] = None,
@@ -118,19 +155,17 @@ class GarminCoordinate(Coordinate):
         self.power = power
         self.cadence = cadence
 
+        for key in self.DERIVED_METRIC_KEYS:
+            if key in _kwargs:
+                setattr(self, key, _kwargs[key])
+
     def __copy__(self) -> "GarminCoordinate":
         return type(self)(
-            self.timestamp,
-            self.distance,
-            self.altitude,
-            self.temperature,
-            self.heart_rate,
-            self.speed,
-            self.enhanced_speed,
-            self.position_lat,
-            self.position_long,
-            self.power,
-            self.cadence,
+            **{
+                key: value
+                for key, value in self.__dict__.items()
+                if key not in ["latitude", "longitude"]
+            }
         )
 
     def __str__(self) -> str:
@@ -175,45 +210,83 @@ class Segment:
     def _get_filtered_coordinates(
         self, coordinates: List[Coordinate]
     ) -> List[Coordinate]:
-        reversed_coordinates = []
-        for coordinate in coordinates[::-1]:
+        """
+        Coordinates with a position, leaving out the ones that are 1 km or more
+        from the next one kept, i.e. GPS jumps.
+        """
+        coordinates = [
+            coordinate
+            for coordinate in coordinates
+            if coordinate.latitude is not None and coordinate.longitude is not None
+        ]
+        if len(coordinates) < 2:
+            return coordinates
+
+        # the haversine distance is within half a percent of the geodesic one,
+        # which is only worth computing for the steps close to 1 km
+        steps = _haversine_distances(
+            np.array([coordinate.latitude for coordinate in coordinates]),
+            np.array([coordinate.longitude for coordinate in coordinates]),
+        )
+        is_short_step = steps < 1000 * (1 - GEODESIC_TOLERANCE)
+        if np.all(is_short_step):
+            return coordinates
+
+        # distances only need computing again after a coordinate is left out
+        is_short_step = is_short_step.tolist()
+        reversed_coordinates = [coordinates[-1]]
+        next_index = len(coordinates) - 1
+        for index in range(len(coordinates) - 2, -1, -1):
+            coordinate = coordinates[index]
             if (
-                coordinate.latitude is not None
-                and coordinate.longitude is not None
-                and (
-                    len(reversed_coordinates) == 0
-                    or Coordinate.distance(coordinate, reversed_coordinates[-1]) < 1
-                )
-            ):
+                next_index == index + 1 and is_short_step[index]
+            ) or Coordinate._is_within_a_km(coordinate, coordinates[next_index]):
                 reversed_coordinates.append(coordinate)
+                next_index = index
         return reversed_coordinates[::-1]
 
-    # TODO: optimize using binary search
-    @functools.lru_cache(maxsize=None)
     def get_coordinate(self, time: datetime) -> Optional[Coordinate]:
-        result = None
-
-        for a, b in zip(self.coordinates[:-1], self.coordinates[1:]):
-            if a.timestamp <= time <= b.timestamp:
-                a_timestamp = a.timestamp.timestamp()
-                b_timestamp = b.timestamp.timestamp()
-
-                time_delta = b_timestamp - a_timestamp
-                # why care if there is a gap > 1.5 secs?
-                # because this indicates gps stopped recording
-                if time_delta < 0.0001 or time_delta > 1.5:
-                    result = copy(a)
-                    break
-
-                weight = (b_timestamp - time.timestamp()) / (b_timestamp - a_timestamp)
-                result = a.weighted_average(b, 1.0 - weight)
-                break
-
-        if result is not None:
-            result.set_timestamp(time)
-
+        if len(self.coordinates) < 2:
+            return None
+
+        # the first pair of coordinates a, b with a.timestamp <= time <= b.timestamp
+        index = bisect.bisect_left(self._get_timestamps(), time)
+        if index == 0 and self.coordinates[0].timestamp == time:
+            index = 1
+        if index == 0 or index == len(self.coordinates):
+            return None
+        a, b = self.coordinates[index - 1], self.coordinates[index]
+
+        a_timestamp = a.timestamp.timestamp()
+        b_timestamp = b.timestamp.timestamp()
+
+        time_delta = b_timestamp - a_timestamp
+        # why care if there is a gap > 1.5 secs?
+        # because this indicates gps stopped recording
+        if time_delta < 0.0001 or time_delta > 1.5:
+            result = copy(a)
+        else:
+            weight = (b_timestamp - time.timestamp()) / (b_timestamp - a_timestamp)
+            result = a.weighted_average(b, 1.0 - weight)
+
+        result.set_timestamp(time)
         return result
 
+    def _get_timestamps(self) -> List[datetime]:
+        # built on first use, as coordinates are only read after construction
+        if self.__dict__.get("_timestamps") is None:
+            self._timestamps = [coordinate.timestamp for coordinate in self.coordinates]
+        return self._timestamps
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # lookup caches are rebuilt on first use rather than pickled into every
+        # panel task and the shard cache
+        return {
+            key: value
+            for key, value in self.__dict__.items()
+            if key not in ("_timestamps", "_spatial_index")
+        }
+
     def get_start_time(self) -> datetime:
         return self.coordinates[0].timestamp
 
@@ -267,11 +340,78 @@ class GarminSegment(Segment):
         return super().get_coordinate(time)
 
     def __init__(
-        self, coordinates: List[GarminCoordinate], laps: List["GarminLap"] = []
+        self,
+        coordinates: List[GarminCoordinate],
+        laps: List["GarminLap"] = [],
+        rider_weight: Optional[float] = None,
     ) -> None:
         super().__init__(coordinates)
         self.coordinates: List[GarminCoordinate] = self.coordinates
         self.laps = laps
+        self.rider_weight = rider_weight
+
+    def get_spatial_index(self) -> "SpatialIndex":
+        """Spatial index over the positions of the ride, built on first use."""
+        from spatial import SpatialIndex
+
+        if self.__dict__.get("_spatial_index") is None:
+            self._spatial_index = SpatialIndex.from_segment(self)
+        return self._spatial_index
+
+    def get_elapsed_seconds(self) -> np.ndarray:
+        start = self.get_start_time().timestamp()
+        return np.array(
+            [coordinate.timestamp.timestamp() - start for coordinate in self.coordinates],
+            dtype=float,
+        )
+
+    def get_record_array(self, key: str) -> np.ndarray:
+        """Values of a record field as floats, NaN where the field is missing."""
+        values = []
+        for coordinate in self.coordinates:
+            value = coordinate.__dict__.get(key)
+            if type(value) is Speed:
+                value = value.get_meters_per_second()
+            values.append(np.nan if value is None else value)
+        return np.array(values, dtype=float)
+
+    def get_rider_weight(self, rider_weight: Optional[float] = None) -> Optional[float]:
+        """The given rider weight, e.g. from a render config, or the FIT profile one."""
+        return rider_weight if rider_weight is not None else self.rider_weight
+
+    def add_derived_metrics(self) -> None:
+        """
+        Compute metrics derived from the raw records and attach them to every
+        coordinate, so they can be displayed by key exactly like raw FIT fields.
+        Watts per kg depend on the rider weight of a render, so they are computed
+        from power_3s when the stats are drawn instead.
+        """
+        if len(self.coordinates) == 0:
+            return
+
+        seconds = self.get_elapsed_seconds()
+        power = np.nan_to_num(self.get_record_array("power"))
+        altitude = self.get_record_array("altitude")
+        distance = self.get_record_array("distance")
+
+        power_30s = _rolling_mean(seconds, power, 30.0)
+        metrics = {
+            "power_3s": _rolling_mean(seconds, power, 3.0),
+            "power_10s": _rolling_mean(seconds, power, 10.0),
+            "power_30s": power_30s,
+            # the running fourth-power mean of 30s power, i.e. normalized
+            # power for the ride so far
+            "normalized_power": np.power(
+                np.cumsum(np.power(power_30s, 4)) / np.arange(1, len(power_30s) + 1),
+                0.25,
+            ),
+            "gradient": _rolling_gradient(distance, altitude, 50.0),
+            "vam": np.clip(_rolling_rate(seconds, altitude, 60.0) * 3600, 0, None),
+        }
+        for key, values in metrics.items():
+            values = np.where(np.isfinite(values), values, np.nan).tolist()
+            for coordinate, value in zip(self.coordinates, values):
+                setattr(coordinate, key, None if value != value else value)
 
     def write_to_csv(self, file_path):
         with open(file_path, "w") as csvfile:
@@ -318,27 +458,331 @@ class GarminSegment(Segment):
 
     @staticmethod
     def load_from_fit_file(path: str) -> "GarminSegment":
-        stream = Stream.from_file(path)
-
-        decoder = Decoder(stream)
-        messages, _ = decoder.read()
-
-        coordinates = []
-        for message in messages["record_mesgs"]:
-            message = {key: message[key] for key in message if type(key) == str}
-            message = {
-                **message,
-                "speed": Speed(meters_per_second=message.get("speed", None)),
-                "enhanced_speed": Speed(meters_per_second=message.get("enhanced_speed", None)),
+        """
+        Load a FIT activity with the record-only decoder of fit.py, which gives
+        the same records, laps and rider weight as the SDK in a fraction of the
+        time. Records without a timestamp are left out.
+        """
+        from fit import (
+            FIT_EPOCH,
+            RECORD_FIELDS,
+            decode_fit_file,
+            is_integer_field,
+            to_datetimes,
+            to_values,
+        )
+
+        activity = decode_fit_file(path)
+        records = activity.records
+        # newer devices often only record the enhanced altitude
+        enhanced_altitude = records.pop("enhanced_altitude")
+        records["altitude"] = np.where(
+            np.isnan(records["altitude"]), enhanced_altitude, records["altitude"]
+        )
+        known = ~np.isnan(records["timestamp"])
+
+        # the objects of every record are created at once, which would set off
+        # many garbage collections that have nothing to free
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            columns = {
+                key: to_values(values[known], is_integer_field(RECORD_FIELDS, key))
+                for key, values in records.items()
+                if key != "timestamp"
             }
-            coordinates.append(GarminCoordinate(**message))
+            columns["timestamp"] = to_datetimes(records["timestamp"][known])
+            for key in ["speed", "enhanced_speed"]:
+                columns[key] = [
+                    Speed(meters_per_second=value) for value in columns[key]
+                ]
+
+            keys = list(columns)
+            coordinates = [
+                GarminCoordinate(**dict(zip(keys, values)))
+                for values in zip(*columns.values())
+            ]
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
+        laps = [
+            GarminLap(FIT_EPOCH + timedelta(seconds=start_time), lap_trigger)
+            for start_time, lap_trigger in zip(
+                activity.laps["start_time"].tolist(), activity.get_lap_triggers()
+            )
+            if start_time == start_time
+        ]
 
+        return GarminSegment(coordinates, laps=laps, rider_weight=activity.rider_weight)
+
+    @staticmethod
+    def load_from_gpx_file(path: str) -> "GarminSegment":
+        """
+        Stream a GPX track, reading heart rate, cadence and temperature from the
+        Garmin TrackPointExtension and power from the extensions. GPX has no laps,
+        so waypoints with a time are used as manual laps.
+        """
+        coordinates: List[GarminCoordinate] = []
         laps = []
-        for message in messages["lap_mesgs"]:
-            message = {key: message[key] for key in message if type(key) == str}
-            laps.append(GarminLap(**message))
+        for tag, element in _iterparse_elements(path, {"trkpt", "wpt"}):
+            fields = _get_leaf_texts(element)
+            if tag == "wpt":
+                if "time" in fields:
+                    laps.append(GarminLap(_parse_xml_time(fields["time"]), "manual"))
+                continue
+
+            coordinate = _build_coordinate(
+                coordinates[-1] if len(coordinates) > 0 else None,
+                timestamp=fields.get("time"),
+                latitude=element.get("lat"),
+                longitude=element.get("lon"),
+                altitude=fields.get("ele"),
+                speed=fields.get("speed"),
+                heart_rate=fields.get("hr"),
+                cadence=fields.get("cad"),
+                power=fields.get("power", fields.get("watts")),
+                temperature=fields.get("atemp"),
+            )
+            if coordinate is not None:
+                coordinates.append(coordinate)
+
+        laps.sort(key=lambda lap: lap.start_time)
         return GarminSegment(coordinates, laps=laps)
 
+    @staticmethod
+    def load_from_tcx_file(path: str) -> "GarminSegment":
+        """
+        Stream a TCX activity, reading speed and power from the Garmin activity
+        extension. Laps keep their trigger method, so manual laps align like
+        the ones of a FIT file.
+        """
+        coordinates: List[GarminCoordinate] = []
+        laps = []
+        for tag, element in _iterparse_elements(path, {"Trackpoint", "Lap"}):
+            if tag == "Lap":
+                trigger_method = element.findtext("{*}TriggerMethod", "Manual")
+                laps.append(
+                    GarminLap(
+                        _parse_xml_time(element.get("StartTime")),
+                        TCX_LAP_TRIGGERS.get(
+                            trigger_method.strip(), trigger_method.strip().lower()
+                        ),
+                    )
+                )
+                continue
+
+            fields = _get_leaf_texts(element)
+            coordinate = _build_coordinate(
+                coordinates[-1] if len(coordinates) > 0 else None,
+                timestamp=fields.get("Time"),
+                latitude=fields.get("LatitudeDegrees"),
+                longitude=fields.get("LongitudeDegrees"),
+                altitude=fields.get("AltitudeMeters"),
+                distance=fields.get("DistanceMeters"),
+                speed=fields.get("Speed"),
+                # the only Value of a trackpoint is the one inside HeartRateBpm
+                heart_rate=fields.get("Value"),
+                cadence=fields.get("Cadence", fields.get("RunCadence")),
+                power=fields.get("Watts"),
+            )
+            if coordinate is not None:
+                coordinates.append(coordinate)
+
+        return GarminSegment(coordinates, laps=laps)
+
+    @staticmethod
+    def load_from_file(path: str) -> "GarminSegment":
+        """Load a FIT, GPX or TCX activity, picking the loader by file extension."""
+        loaders = {
+            ".fit": GarminSegment.load_from_fit_file,
+            ".gpx": GarminSegment.load_from_gpx_file,
+            ".tcx": GarminSegment.load_from_tcx_file,
+        }
+        extension = os.path.splitext(path)[1].lower()
+        assert extension in loaders, f"Unsupported activity file {path}"
+        return loaders[extension](path)
+
+
+# TCX trigger methods by the name of the matching FIT lap trigger
+TCX_LAP_TRIGGERS = {
+    "Manual": "manual",
+    "Distance": "distance",
+    "Location": "position_lap",
+    "Time": "time",
+}
+
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _iterparse_elements(path: str, tags: set):
+    """
+    Yield every element with one of the given tags, ignoring namespaces, as soon
+    as it has been parsed. The element is dropped from the tree afterwards, so
+    memory does not grow with the length of the file.
+    """
+    parents = []
+    for event, element in ElementTree.iterparse(path, events=("start", "end")):
+        if event == "start":
+            parents.append(element)
+            continue
+
+        parents.pop()
+        tag = _local_name(element.tag)
+        if tag in tags:
+            yield tag, element
+            element.clear()
+            if len(parents) > 0:
+                parents[-1].remove(element)
+
+
+def _get_leaf_texts(element: ElementTree.Element) -> Dict[str, str]:
+    """Text of every leaf below the element by tag, ignoring namespaces."""
+    return {
+        _local_name(child.tag): child.text.strip()
+        for child in element.iter()
+        if child is not element and len(child) == 0 and child.text
+    }
+
+
+def _parse_xml_time(text: str) -> datetime:
+    timestamp = datetime.fromisoformat(text.strip().replace("Z", "+00:00"))
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(timezone.utc)
+
+
+def _haversine_distance(
+    latitude: float, longitude: float, other_latitude: float, other_longitude: float
+) -> float:
+    latitude, longitude, other_latitude, other_longitude = map(
+        math.radians, [latitude, longitude, other_latitude, other_longitude]
+    )
+    a = (
+        math.sin((other_latitude - latitude) / 2) ** 2
+        + math.cos(latitude)
+        * math.cos(other_latitude)
+        * math.sin((other_longitude - longitude) / 2) ** 2
+    )
+    return 2 * 6371008.8 * math.asin(math.sqrt(a))
+
+
+def _haversine_distances(latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+    """Haversine distances in meters between consecutive points."""
+    latitudes, longitudes = np.radians(latitudes), np.radians(longitudes)
+    a = (
+        np.sin(np.diff(latitudes) / 2) ** 2
+        + np.cos(latitudes[:-1])
+        * np.cos(latitudes[1:])
+        * np.sin(np.diff(longitudes) / 2) ** 2
+    )
+    return 2 * 6371008.8 * np.arcsin(np.sqrt(a))
+
+
+def _build_coordinate(
+    previous: Optional[GarminCoordinate],
+    timestamp: Optional[str],
+    latitude: Optional[str],
+    longitude: Optional[str],
+    altitude: Optional[str] = None,
+    distance: Optional[str] = None,
+    speed: Optional[str] = None,
+    heart_rate: Optional[str] = None,
+    cadence: Optional[str] = None,
+    power: Optional[str] = None,
+    temperature: Optional[str] = None,
+) -> Optional[GarminCoordinate]:
+    """
+    Coordinate from the text of a GPX or TCX track point, in the same units as
+    a FIT record. Distance and speed are derived from the previous point when
+    the file does not record them.
+    """
+    if timestamp is None:
+        return None
+
+    def to_float(text: Optional[str]) -> Optional[float]:
+        return None if text is None else float(text)
+
+    def to_int(text: Optional[str]) -> Optional[int]:
+        return None if text is None else round(float(text))
+
+    time = _parse_xml_time(timestamp)
+    latitude, longitude = to_float(latitude), to_float(longitude)
+    distance, speed = to_float(distance), to_float(speed)
+
+    if distance is None:
+        distance = 0.0
+        if previous is not None:
+            distance = previous.distance or 0.0
+            if None not in [latitude, longitude, previous.latitude, previous.longitude]:
+                distance += _haversine_distance(
+                    previous.latitude, previous.longitude, latitude, longitude
+                )
+
+    if speed is None and previous is not None and previous.distance is not None:
+        elapsed = (time - previous.timestamp).total_seconds()
+        if elapsed > 0:
+            speed = (distance - previous.distance) / elapsed
+
+    position_lat, position_long = [
+        None if value is None else value * GarminCoordinate.INT_TO_FLOAT_LAT_LONG_CONST
+        for value in [latitude, longitude]
+    ]
+
+    return GarminCoordinate(
+        timestamp=time,
+        distance=distance,
+        temperature=to_int(temperature),
+        altitude=to_float(altitude),
+        heart_rate=to_int(heart_rate),
+        speed=Speed(meters_per_second=speed),
+        enhanced_speed=Speed(meters_per_second=speed),
+        position_lat=position_lat,
+        position_long=position_long,
+        power=to_int(power),
+        cadence=to_int(cadence),
+    )
+
+
+def _window_starts(positions: np.ndarray, window: float) -> np.ndarray:
+    """Index of the first sample inside the trailing window ending at each sample."""
+    return np.searchsorted(positions, positions - window, side="right")
+
+
+def _rolling_mean(seconds: np.ndarray, values: np.ndarray, window: float) -> np.ndarray:
+    sums = np.concatenate(([0.0], np.cumsum(values)))
+    ends = np.arange(1, len(values) + 1)
+    starts = _window_starts(seconds, window)
+    return (sums[ends] - sums[starts]) / (ends - starts)
+
+
+def _rolling_rate(seconds: np.ndarray, values: np.ndarray, window: float) -> np.ndarray:
+    starts = _window_starts(seconds, window)
+    elapsed = seconds - seconds[starts]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(elapsed > 0, (values - values[starts]) / elapsed, np.nan)
+
+
+def get_monotonic_distances(distances: np.ndarray) -> np.ndarray:
+    """
+    Record distances that never decrease, with a missing distance replaced by
+    the one before it, or by 0 at the start of the ride.
+    """
+    # distance can go missing or jitter backwards when the sensor drops out
+    return np.fmax.accumulate(np.nan_to_num(distances))
+
+
+def _rolling_gradient(
+    distance: np.ndarray, altitude: np.ndarray, window: float
+) -> np.ndarray:
+    distance = get_monotonic_distances(distance)
+    starts = _window_starts(distance, window)
+    run = distance - distance[starts]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(run > 0, (altitude - altitude[starts]) / run * 100, np.nan)
+
 
 class SegmentIterator:
     def __init__(self, segment: Segment, iterator_step_length: timedelta) -> None:
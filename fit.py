@@ -0,0 +1,409 @@
+"""
+Fast decoding of the records, laps and rider weight of a FIT file.
+
+The Garmin FIT SDK decodes every message of a file into dicts, which is most of
+the time it takes to load a long activity. This decoder memory-maps the file
+and walks the message headers once, reading only definition messages and noting
+where the record, lap and user profile messages start. The fields that are used
+are then read for all messages of a definition at once into NumPy arrays, with
+the scale, offset and invalid values of the SDK.
+
+Check it against the SDK, and time both, on some activity files:
+
+    python fit.py --fit-files ride.fit multi-day-tour.fit
+"""
+
+import argparse
+import mmap
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+FIT_EPOCH = datetime(1989, 12, 31, tzinfo=timezone.utc)
+
+USER_PROFILE_MESG_NUM = 3
+LAP_MESG_NUM = 19
+RECORD_MESG_NUM = 20
+
+# field number: (name, scale, offset), as in the FIT profile
+RECORD_FIELDS = {
+    253: ("timestamp", 1, 0),
+    0: ("position_lat", 1, 0),
+    1: ("position_long", 1, 0),
+    2: ("altitude", 5, 500),
+    3: ("heart_rate", 1, 0),
+    4: ("cadence", 1, 0),
+    5: ("distance", 100, 0),
+    6: ("speed", 1000, 0),
+    7: ("power", 1, 0),
+    13: ("temperature", 1, 0),
+    73: ("enhanced_speed", 1000, 0),
+    78: ("enhanced_altitude", 5, 500),
+}
+LAP_FIELDS = {
+    2: ("start_time", 1, 0),
+    24: ("lap_trigger", 1, 0),
+}
+USER_PROFILE_FIELDS = {
+    4: ("weight", 10, 0),
+}
+MESG_FIELDS = {
+    RECORD_MESG_NUM: RECORD_FIELDS,
+    LAP_MESG_NUM: LAP_FIELDS,
+    USER_PROFILE_MESG_NUM: USER_PROFILE_FIELDS,
+}
+# record fields the SDK fills from another field when that one is valid
+EXPANDED_RECORD_FIELDS = {
+    "enhanced_speed": "speed",
+    "enhanced_altitude": "altitude",
+}
+
+LAP_TRIGGERS = [
+    "manual",
+    "time",
+    "distance",
+    "position_start",
+    "position_lap",
+    "position_waypoint",
+    "position_marked",
+    "session_end",
+    "fitness_equipment",
+]
+
+# base type number: (NumPy type, invalid value), None for any NaN
+BASE_TYPES = {
+    0x00: ("u1", 0xFF),
+    0x01: ("i1", 0x7F),
+    0x02: ("u1", 0xFF),
+    0x03: ("i2", 0x7FFF),
+    0x04: ("u2", 0xFFFF),
+    0x05: ("i4", 0x7FFFFFFF),
+    0x06: ("u4", 0xFFFFFFFF),
+    0x08: ("f4", None),
+    0x09: ("f8", None),
+    0x0A: ("u1", 0),
+    0x0B: ("u2", 0),
+    0x0C: ("u4", 0),
+    0x0D: ("u1", 0xFF),
+    0x0E: ("i8", 0x7FFFFFFFFFFFFFFF),
+    0x0F: ("u8", 0xFFFFFFFFFFFFFFFF),
+    0x10: ("u8", 0),
+}
+
+COMPRESSED_TIMESTAMP_HEADER = 0x80
+DEFINITION_HEADER = 0x40
+DEVELOPER_DATA_HEADER = 0x20
+LOCAL_MESG_NUM_MASK = 0x0F
+
+
+class MessageDefinition:
+    def __init__(
+        self,
+        global_mesg_num: int,
+        little_endian: bool,
+        fields: Dict[int, Tuple[int, int, int]],
+        size: int,
+    ) -> None:
+        self.global_mesg_num = global_mesg_num
+        self.little_endian = little_endian
+        # field number: (offset in the message, size, base type number)
+        self.fields = fields
+        self.size = size
+        # where the data messages of this definition start in the file
+        self.offsets: List[int] = []
+
+
+class FitActivity:
+    def __init__(
+        self,
+        records: Dict[str, np.ndarray],
+        laps: Dict[str, np.ndarray],
+        rider_weight: Optional[float],
+    ) -> None:
+        # values by field name, in file order, NaN where a field is missing
+        self.records = records
+        self.laps = laps
+        self.rider_weight = rider_weight
+
+    def get_lap_triggers(self) -> List[Union[str, int, None]]:
+        """Lap trigger names, or the raw value when the profile has no name for it."""
+        return [
+            None if value != value
+            else LAP_TRIGGERS[int(value)] if int(value) < len(LAP_TRIGGERS)
+            else int(value)
+            for value in self.laps["lap_trigger"].tolist()
+        ]
+
+
+def to_datetimes(timestamps: np.ndarray) -> List[datetime]:
+    return [FIT_EPOCH + timedelta(seconds=value) for value in timestamps.tolist()]
+
+
+def to_values(values: np.ndarray, integer: bool) -> List[Union[int, float, None]]:
+    """
+    Values as Python numbers, None where NaN, like the SDK gives them: integers
+    for fields without a scale or offset, floats for the others.
+    """
+    result = np.full(len(values), None, dtype=object)
+    known = ~np.isnan(values)
+    result[known] = values[known].astype(np.int64) if integer else values[known]
+    return result.tolist()
+
+
+def is_integer_field(
+    field_profiles: Dict[int, Tuple[str, float, float]], name: str
+) -> bool:
+    return any(
+        field_name == name and scale == 1 and offset == 0
+        for field_name, scale, offset in field_profiles.values()
+    )
+
+
+def scan_messages(data: mmap.mmap) -> List[MessageDefinition]:
+    """
+    Definitions of the record, lap and user profile messages of every chained
+    FIT file in data, along with where their data messages start.
+    """
+    definitions = []
+    # the sizes and data message offsets of the current local definitions, the
+    # offsets being None for messages that are skipped
+    local_sizes = [0] * (LOCAL_MESG_NUM_MASK + 1)
+    local_offsets: List[Optional[List[int]]] = [None] * (LOCAL_MESG_NUM_MASK + 1)
+
+    position = 0
+    length = len(data)
+    while position + 12 <= length:
+        header_size = data[position]
+        data_size = int.from_bytes(data[position + 4 : position + 8], "little")
+        assert data[position + 8 : position + 12] == b".FIT", "Not a FIT file"
+        position += header_size
+        end = min(position + data_size, length)
+
+        while position < end:
+            header = data[position]
+            position += 1
+
+            if header & COMPRESSED_TIMESTAMP_HEADER:
+                # not supported by the SDK either, which stops decoding here
+                print(
+                    "Stopped decoding at a compressed timestamp message, "
+                    "which is not supported."
+                )
+                return definitions
+
+            local_mesg_num = header & LOCAL_MESG_NUM_MASK
+            if not header & DEFINITION_HEADER:
+                offsets = local_offsets[local_mesg_num]
+                if offsets is not None:
+                    offsets.append(position)
+                position += local_sizes[local_mesg_num]
+                continue
+
+            little_endian = data[position + 1] == 0
+            global_mesg_num = int.from_bytes(
+                data[position + 2 : position + 4], "little" if little_endian else "big"
+            )
+            num_fields = data[position + 4]
+            position += 5
+
+            fields = {}
+            size = 0
+            for _ in range(num_fields):
+                number, field_size, base_type = data[position : position + 3]
+                fields[number] = (size, field_size, base_type & 0x1F)
+                size += field_size
+                position += 3
+            if header & DEVELOPER_DATA_HEADER:
+                num_developer_fields = data[position]
+                position += 1
+                for _ in range(num_developer_fields):
+                    size += data[position + 1]
+                    position += 3
+
+            definition = MessageDefinition(global_mesg_num, little_endian, fields, size)
+            local_sizes[local_mesg_num] = size
+            local_offsets[local_mesg_num] = None
+            if global_mesg_num in MESG_FIELDS:
+                definitions.append(definition)
+                local_offsets[local_mesg_num] = definition.offsets
+
+        # skip the CRC at the end of every file
+        position = end + 2
+
+    return definitions
+
+
+def _read_field(
+    messages: np.ndarray, definition: MessageDefinition, number: int
+) -> Optional[np.ndarray]:
+    """Raw values of a field as floats, NaN where invalid, None if not defined."""
+    if number not in definition.fields:
+        return None
+    offset, size, base_type = definition.fields[number]
+    if base_type not in BASE_TYPES:
+        return None
+    type_code, invalid = BASE_TYPES[base_type]
+    dtype = np.dtype(type_code).newbyteorder("<" if definition.little_endian else ">")
+    # the SDK reads fields of an odd size as bytes, and arrays are not expected
+    # for any field that is read here, so only their first value is kept
+    if size == 0 or size % dtype.itemsize != 0:
+        return None
+
+    raw = np.ascontiguousarray(messages[:, offset : offset + dtype.itemsize])
+    raw = raw.view(dtype)[:, 0]
+    values = raw.astype(float)
+    if invalid is None:
+        values[~np.isfinite(values)] = np.nan
+    else:
+        values[raw == invalid] = np.nan
+    return values
+
+
+def read_messages(
+    data: np.ndarray,
+    definitions: List[MessageDefinition],
+    field_profiles: Dict[int, Tuple[str, float, float]],
+) -> Dict[str, np.ndarray]:
+    """Scaled values of the fields of the messages of the definitions, in file order."""
+    offsets = []
+    columns: Dict[str, List[np.ndarray]] = {
+        name: [] for name, _, _ in field_profiles.values()
+    }
+    for definition in definitions:
+        definition_offsets = np.array(definition.offsets, dtype=np.int64)
+        # leaving out the last message of a truncated file
+        definition_offsets = definition_offsets[
+            definition_offsets + definition.size <= len(data)
+        ]
+        messages = data[definition_offsets[:, None] + np.arange(definition.size)]
+
+        offsets.append(definition_offsets)
+        for number, (name, scale, offset) in field_profiles.items():
+            values = _read_field(messages, definition, number)
+            if values is None:
+                values = np.full(len(definition_offsets), np.nan)
+            elif scale != 1 or offset != 0:
+                values = values / scale - offset
+            columns[name].append(values)
+
+    order = np.argsort(np.concatenate(offsets + [np.zeros(0, dtype=np.int64)]))
+    return {
+        name: np.concatenate(values + [np.zeros(0)])[order]
+        for name, values in columns.items()
+    }
+
+
+def decode_fit_file(path: str) -> FitActivity:
+    """Records, laps and rider weight of a FIT file, as the SDK would decode them."""
+    with open(path, "rb") as fit_file:
+        with mmap.mmap(fit_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            definitions = scan_messages(data)
+            buffer = np.frombuffer(data, dtype=np.uint8)
+            messages = {
+                mesg_num: read_messages(
+                    buffer,
+                    [
+                        definition
+                        for definition in definitions
+                        if definition.global_mesg_num == mesg_num
+                    ],
+                    fields,
+                )
+                for mesg_num, fields in MESG_FIELDS.items()
+            }
+            # views into the mapped file have to go before it is closed
+            del buffer
+
+    records = messages[RECORD_MESG_NUM]
+    for name, source in EXPANDED_RECORD_FIELDS.items():
+        records[name] = np.where(
+            np.isnan(records[source]), records[name], records[source]
+        )
+
+    weights = messages[USER_PROFILE_MESG_NUM]["weight"]
+    weights = weights[~np.isnan(weights)]
+    return FitActivity(
+        records=records,
+        laps=messages[LAP_MESG_NUM],
+        rider_weight=float(weights[-1]) if len(weights) > 0 else None,
+    )
+
+
+def _get_sdk_values(messages: List[Dict], name: str) -> np.ndarray:
+    values = []
+    for message in messages:
+        value = message.get(name)
+        if isinstance(value, datetime):
+            value = (value - FIT_EPOCH).total_seconds()
+        elif isinstance(value, list):
+            # the values of an array field, only the first of which is read
+            value = value[0]
+        values.append(np.nan if value is None else value)
+    return np.array(values, dtype=float)
+
+
+def compare_with_sdk(path: str) -> List[str]:
+    """Differences between this decoder and the FIT SDK on a file, timing both."""
+    from garmin_fit_sdk import Decoder, Stream
+
+    sdk_start_time = time.time()
+    sdk_messages, errors = Decoder(Stream.from_file(path)).read()
+    sdk_seconds = time.time() - sdk_start_time
+
+    start_time = time.time()
+    activity = decode_fit_file(path)
+    seconds = time.time() - start_time
+
+    differences = [f"SDK error: {error}" for error in errors]
+    for key, fields, values in [
+        ("record_mesgs", RECORD_FIELDS, activity.records),
+        ("lap_mesgs", LAP_FIELDS, activity.laps),
+    ]:
+        for name, _, _ in fields.values():
+            if name == "lap_trigger":
+                continue
+            expected = _get_sdk_values(sdk_messages.get(key, []), name)
+            if not np.array_equal(expected, values[name], equal_nan=True):
+                differences.append(f"{key} {name} differs")
+
+    lap_triggers = [
+        message.get("lap_trigger") for message in sdk_messages.get("lap_mesgs", [])
+    ]
+    if lap_triggers != activity.get_lap_triggers():
+        differences.append("lap_mesgs lap_trigger differs")
+
+    rider_weight = None
+    for message in sdk_messages.get("user_profile_mesgs", []):
+        rider_weight = message.get("weight", rider_weight)
+    if rider_weight != activity.rider_weight:
+        differences.append(f"weight {activity.rider_weight} instead of {rider_weight}")
+
+    print(
+        f"{path}: {len(activity.records['timestamp'])} records and "
+        f"{len(activity.laps['start_time'])} laps in {seconds:.3f}s, "
+        f"{sdk_seconds:.3f}s with the SDK ({sdk_seconds / seconds:.0f}x)"
+    )
+    return differences
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the fast FIT decoder with the FIT SDK"
+    )
+    parser.add_argument(
+        "--fit-files",
+        help="FIT files to decode with both",
+        required=True,
+        type=str,
+        nargs="*",
+    )
+    args = vars(parser.parse_args())
+
+    for path in args["fit_files"]:
+        differences = compare_with_sdk(path)
+        for difference in differences:
+            print(f"  {difference}")
+        if len(differences) == 0:
+            print("  Same records, laps and rider weight as the SDK.")
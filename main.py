@@ -1,154 +1,353 @@
 import argparse
-from coordinate import GarminSegment
+import sys
 from datetime import timedelta
-from render import ThreadedPanelRenderer, VideoRenderer
-from video import GoProVideo
-import time
-import json
-
-parser = argparse.ArgumentParser(
-    description="Program to add metadata to cycling video from GoPro"
-)
-parser.add_argument("--fit-file", help="FIT file of ride", required=True, type=str)
-parser.add_argument(
-    "--video-files",
-    help="Video files of ride",
-    required=True,
-    type=str,
-    nargs="*",
-)
-parser.add_argument(
-    "--video-length-in-secs",
-    help="How many seconds the rendered video should last",
-    type=float,
-    default=None,
-)
-parser.add_argument(
-    "--video-offset-start-in-secs",
-    help="How many seconds into the input video should the output video start",
-    default=0.0,
-    type=float,
-)
-parser.add_argument(
-    "--video-output-path",
-    help="The output path for the video you will render",
-    type=str,
-    required=True,
-)
-parser.add_argument(
-    "--video-lap-time-in-secs",
-    help="How long into the input video until you pressed the Garmin lap button",
-    required=True,
-    type=float,
-)
-parser.add_argument(
-    "--lap-time-search-window-in-secs",
-    help="""The window used to search for the lap button press moment in the Garmin file. 
-    This helps deal with misalignemnt in clock times between your camera and your Garmin computer""",
-    required=True,
-    type=float,
-    nargs=2,
-)
-parser.add_argument(
-    "--render-config-file",
-    help="Render config file to determine video render style and number of threads to use on the computer doing the rendering",
-    required=True,
-    type=str,
-)
-args = vars(parser.parse_args())
+from typing import Any, Dict, List
 
+# only modules that are cheap to import are imported here, so --help and align
+# never load matplotlib or ffmpeg-python, and probe never loads matplotlib
+import pipeline
 
-if __name__ == "__main__":
-    video_output_path = args["video_output_path"]
-    left_search_bound = timedelta(seconds=args["lap_time_search_window_in_secs"][0])
-    right_search_bound = timedelta(seconds=args["lap_time_search_window_in_secs"][1])
-    lap_time = timedelta(seconds=args["video_lap_time_in_secs"])
-    video_offset = timedelta(seconds=args["video_offset_start_in_secs"])
 
-    video = GoProVideo(args["video_files"])
+COMMANDS = ["probe", "align", "render", "highlights", "segments"]
+
 
-    video_length = (
-        timedelta(seconds=args["video_length_in_secs"])
-        if args["video_length_in_secs"] is not None
-        else video.get_duration()
+def add_video_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--video-files",
+        help="Video files of ride",
+        required=True,
+        type=str,
+        nargs="*",
     )
 
-    render_config_file = open(args["render_config_file"])
-    render_config = json.loads(render_config_file.read())
 
-    garmin_segment = GarminSegment.load_from_fit_file(args["fit_file"])
+def add_alignment_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--fit-file", help="FIT, GPX or TCX file of ride", required=True, type=str)
+    add_video_arguments(parser)
+    parser.add_argument(
+        "--video-offset-start-in-secs",
+        help="How many seconds into the input video should the output video start",
+        default=0.0,
+        type=float,
+    )
+    parser.add_argument(
+        "--video-lap-time-in-secs",
+        help="How long into the input video until you pressed the Garmin lap button",
+        required=True,
+        type=float,
+    )
+    parser.add_argument(
+        "--lap-time-search-window-in-secs",
+        help="""The window used to search for the lap button press moment in the Garmin file. 
+        This helps deal with misalignemnt in clock times between your camera and your Garmin computer""",
+        required=True,
+        type=float,
+        nargs=2,
+    )
 
-    print(f"Video start:   {str(video.get_start_time())}")
-    print(f"Video end:     {str(video.get_end_time())}")
-    print(f"Garmin start:  {str(garmin_segment.get_start_time())}")
-    print(f"Garmin end:    {str(garmin_segment.get_end_time())}\n")
 
-    left_search, right_search = (
-        video.get_start_time() + lap_time + left_search_bound,
-        video.get_start_time() + lap_time + right_search_bound,
+def add_output_arguments(parser: argparse.ArgumentParser) -> None:
+    add_alignment_arguments(parser)
+    parser.add_argument(
+        "--video-output-path",
+        help="The output path for the video you will render",
+        type=str,
+        required=True,
+    )
+    parser.add_argument(
+        "--render-config-file",
+        help="Render config file to determine video render style and number of threads to use on the computer doing the rendering",
+        required=True,
+        type=str,
     )
 
-    print("Available lap timestamps:\n")
-    print(
-        "\n".join([str(lap.start_time) for lap in garmin_segment.get_manual_laps()])
-        + "\n"
+
+def add_render_arguments(parser: argparse.ArgumentParser) -> None:
+    add_output_arguments(parser)
+    parser.add_argument(
+        "--video-length-in-secs",
+        help="How many seconds the rendered video should last",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--preview",
+        help="Render a short, scaled down preview instead of the full video",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--preview-at-in-secs",
+        help="How many seconds into the input video the preview should be centered",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--preview-lap",
+        help="Center the preview on this manual lap, counting from 1 in the list of available lap timestamps",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--preview-length-in-secs",
+        help="How many seconds the preview should last",
+        type=float,
+        default=20.0,
+    )
+    parser.add_argument(
+        "--preview-scale",
+        help="Resolution of the preview as a fraction of the output resolution",
+        type=float,
+        default=0.25,
+    )
+    parser.add_argument(
+        "--preview-fps",
+        help="Frame rate of the preview",
+        type=float,
+        default=10.0,
+    )
+    parser.add_argument(
+        "--shards",
+        help="Instead of rendering, split the video into this many shards and write a manifest for shard.py workers",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--shard-work-dir",
+        help="Shared directory for the shard manifest, FIT cache and rendered shards",
+        type=str,
+        default="shards",
     )
-    print(f"Searching for Garmin lap time between {left_search} and {right_search}.")
-    garmin_lap = garmin_segment.get_first_lap(left_search, right_search)
 
-    if garmin_lap is None:
-        print(
-            "Could not find lap coordinate. There must be one to align video. Exiting."
-        )
-        exit()
-    else:
-        print(f"Found Garmin lap time at {garmin_lap.start_time}.\n")
 
-    garmin_lap_time = garmin_lap.start_time
-    go_pro_lap_time = video.get_start_time() + lap_time
+def add_highlights_arguments(parser: argparse.ArgumentParser) -> None:
+    add_output_arguments(parser)
+    parser.add_argument(
+        "--clip",
+        help="Render a clip of this manual lap, counting from 1, starting PRE_ROLL seconds before and ending POST_ROLL seconds after the lap press. Can be repeated. Every manual lap gets a clip if omitted",
+        type=float,
+        nargs=3,
+        metavar=("LAP", "PRE_ROLL", "POST_ROLL"),
+        action="append",
+        default=None,
+    )
+    parser.add_argument(
+        "--pre-roll-in-secs",
+        help="How many seconds before each lap press the clips start when rendering every manual lap",
+        type=float,
+        default=5.0,
+    )
+    parser.add_argument(
+        "--post-roll-in-secs",
+        help="How many seconds after each lap press the clips end when rendering every manual lap",
+        type=float,
+        default=10.0,
+    )
+    parser.add_argument(
+        "--reel",
+        help="Also join the clips into one video at the output path",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--parallel-encodes",
+        help="How many clips to encode at the same time. Defaults to one per 4 video threads",
+        type=int,
+        default=None,
+    )
+
+
+def add_segments_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--fit-file", help="FIT, GPX or TCX file of ride", required=True, type=str)
+    parser.add_argument(
+        "--segments-file",
+        help="""JSON file of reference segments to find in the ride, e.g.
+        {"segments": [{"name": "Hawk Hill", "points": [[lat, long], ...]}]}""",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--match-radius-in-meters",
+        help="How close the ride has to pass to the points of a reference segment",
+        type=float,
+        default=25.0,
+    )
+    parser.add_argument(
+        "--min-climb-gain-in-meters",
+        help="Smallest elevation gain of a detected climb",
+        type=float,
+        default=30.0,
+    )
+    parser.add_argument(
+        "--min-climb-grade",
+        help="Smallest average grade of a detected climb, in percent",
+        type=float,
+        default=3.0,
+    )
+
 
-    garmin_time_shift = garmin_lap_time - go_pro_lap_time
+def parse_args(argv: List[str]) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(
+        description="Program to add metadata to cycling video from GoPro"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    probe_parser = subparsers.add_parser(
+        "probe", help="Print the times, resolution and frame rate of the video files"
+    )
+    add_video_arguments(probe_parser)
+
+    align_parser = subparsers.add_parser(
+        "align", help="Print the laps and time shift used to align video and FIT file"
+    )
+    add_alignment_arguments(align_parser)
+
+    render_parser = subparsers.add_parser(
+        "render", help="Render the video with the data overlay"
+    )
+    add_render_arguments(render_parser)
+
+    highlights_parser = subparsers.add_parser(
+        "highlights", help="Render a highlight clip around each manual lap in one go"
+    )
+    add_highlights_arguments(highlights_parser)
 
+    segments_parser = subparsers.add_parser(
+        "segments", help="Print the climbs and known segments found in the ride"
+    )
+    add_segments_arguments(segments_parser)
+
+    # keep supporting the original invocation without a subcommand
+    if len(argv) > 0 and argv[0] not in COMMANDS and argv[0] not in ["-h", "--help"]:
+        argv = ["render"] + argv
+
+    return vars(parser.parse_args(argv))
+
+
+def probe(args: Dict[str, Any]) -> None:
+    video = pipeline.load_video(args["video_files"])
+
+    width, height = video.get_resolution()
+    print(f"Video start:      {str(video.get_start_time())}")
+    print(f"Video end:        {str(video.get_end_time())}")
+    print(f"Video duration:   {str(video.get_duration())}")
+    print(f"Video resolution: {width}x{height}")
+    print(f"Video fps:        {video.get_fps()}")
+
+
+def align(args: Dict[str, Any]) -> None:
+    video = pipeline.load_video(args["video_files"])
+    garmin_segment = pipeline.load_garmin_segment(args["fit_file"])
+
+    try:
+        garmin_time_shift = pipeline.align(
+            video,
+            garmin_segment,
+            timedelta(seconds=args["video_lap_time_in_secs"]),
+            (
+                timedelta(seconds=args["lap_time_search_window_in_secs"][0]),
+                timedelta(seconds=args["lap_time_search_window_in_secs"][1]),
+            ),
+        )
+    except pipeline.AlignmentError:
+        sys.exit(1)
+
+    video_offset = timedelta(seconds=args["video_offset_start_in_secs"])
     garmin_start_time = video.get_start_time() + video_offset + garmin_time_shift
-    print(f"Garmin time shift: {garmin_time_shift}")
-    print(f"Garmin start time: {garmin_start_time}\n")
-
-    print("Rendering side panels...")
-
-    render_start_time = time.time()
-
-    ThreadedPanelRenderer(
-        segment=garmin_segment,
-        segment_start_time=garmin_start_time,
-        video_length=video_length,
-        video=video,
-        output_folder="panel",
-        num_threads=render_config["panelNumberOfThreads"],
-        panel_width=render_config["panelWidth"],
-        map_height=render_config["map"]["height"],
-        map_opacity=render_config["map"]["opacity"],
-        map_marker_inner_size=render_config["map"]["marker"]["innerSize"],
-        map_marker_inner_opacity=render_config["map"]["marker"]["innerOpacity"],
-        map_marker_outer_size=render_config["map"]["marker"]["outerSize"],
-        map_marker_outer_opacity=render_config["map"]["marker"]["outerOpacity"],
-        stat_keys_and_labels=render_config["stats"]["keysAndLabels"],
-        stats_x_position=render_config["stats"]["xPosition"],
-        stats_y_range=render_config["stats"]["yPositionRange"],
-        stat_label_y_position_delta=render_config["stats"]["statToLabelYDistance"],
-        font_size=render_config["stats"]["fontSize"],
-        label_font_size=render_config["stats"]["labelFontSize"],
-        stats_opacity=render_config["stats"]["opacity"],
-    ).render()
-
-    print("Rendering video...")
-
-    VideoRenderer(
-        video=video,
-        panel_folder="panel",
-        output_filepath=video_output_path,
-        num_threads=render_config["videoNumberOfThreads"],
-        video_length=video_length,
-        video_offset=video_offset,
-    ).render()
-
-    print(f"\nTotal render time: {time.time() - render_start_time} seconds.")
+    print(f"Garmin start time: {garmin_start_time}")
+
+
+def render(args: Dict[str, Any]) -> None:
+    assert not (
+        args["preview"] and args["shards"] is not None
+    ), "Previews can't be sharded"
+
+    try:
+        prepared = pipeline.prepare(pipeline.RenderJob.from_args(args))
+    except pipeline.AlignmentError:
+        print("Exiting.")
+        sys.exit(1)
+
+    if args["shards"] is not None:
+        manifest_path = pipeline.write_shard_manifest(
+            prepared, args["shards"], args["shard_work_dir"]
+        )
+        print(f"Wrote shard manifest to {manifest_path}.")
+        return
+
+    metrics = pipeline.render(prepared)
+
+    print(f"\nTotal render time: {metrics['totalSecs']} seconds.")
+
+
+def highlights(args: Dict[str, Any]) -> None:
+    windows = None
+    if args["clip"] is not None:
+        windows = [
+            pipeline.HighlightWindow(
+                int(lap), timedelta(seconds=pre_roll), timedelta(seconds=post_roll)
+            )
+            for lap, pre_roll, post_roll in args["clip"]
+        ]
+
+    try:
+        clips = pipeline.prepare_highlights(
+            pipeline.RenderJob.from_args(args),
+            windows,
+            pre_roll=timedelta(seconds=args["pre_roll_in_secs"]),
+            post_roll=timedelta(seconds=args["post_roll_in_secs"]),
+        )
+    except pipeline.AlignmentError:
+        print("Exiting.")
+        sys.exit(1)
+
+    metrics = pipeline.render_highlights(
+        clips, reel=args["reel"], parallel_encodes=args["parallel_encodes"]
+    )
+
+    print(f"\nTotal render time: {metrics['totalSecs']} seconds.")
+
+
+def segments(args: Dict[str, Any]) -> None:
+    import spatial
+
+    garmin_segment = pipeline.load_garmin_segment(args["fit_file"])
+    ride_start_time = garmin_segment.get_start_time()
+
+    if args["segments_file"] is not None:
+        matches = spatial.match_segments(
+            garmin_segment,
+            spatial.load_reference_segments(args["segments_file"]),
+            radius=args["match_radius_in_meters"],
+        )
+        print(f"Found {len(matches)} segments:")
+        for match in matches:
+            print(
+                f"{match.name}: {match.start_time} "
+                f"({match.start_time - ride_start_time} into the ride), "
+                f"took {match.get_elapsed_time()}"
+            )
+        print()
+
+    climbs = spatial.detect_climbs(
+        garmin_segment,
+        min_gain=args["min_climb_gain_in_meters"],
+        min_grade=args["min_climb_grade"],
+    )
+    print(f"Found {len(climbs)} climbs:")
+    for number, climb in enumerate(climbs, start=1):
+        print(
+            f"Climb {number}: {climb.start_time} "
+            f"({climb.start_time - ride_start_time} into the ride), "
+            f"{climb.distance / 1000:.1f} km at {climb.average_grade:.1f}%, "
+            f"{climb.gain:.0f} m gain, took {climb.get_elapsed_time()}"
+        )
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    {
+        "probe": probe,
+        "align": align,
+        "render": render,
+        "highlights": highlights,
+        "segments": segments,
+    }[args["command"]](args)
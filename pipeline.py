@@ -0,0 +1,550 @@
+"""
+Importable version of the pipeline behind main.py, shared by the CLI and the
+render service. Probed videos and decoded FIT files are cached for the life of
+the process, so a long running process only pays for them once.
+"""
+
+import functools
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from coordinate import GarminSegment
+from video import GoProVideo
+from alignment import get_garmin_time_shift
+
+# encoder threads per highlight clip when clips are encoded side by side
+MIN_THREADS_PER_ENCODE = 4
+# decoded FIT files kept in memory, dropping the least recently used one first
+MAX_CACHED_GARMIN_SEGMENTS = 4
+
+
+class AlignmentError(Exception):
+    pass
+
+
+class RenderJob:
+    def __init__(
+        self,
+        fit_file: str,
+        video_files: List[str],
+        video_output_path: str,
+        video_lap_time: timedelta,
+        lap_time_search_window: Tuple[timedelta, timedelta],
+        render_config: Dict[str, Any],
+        video_offset: timedelta = timedelta(seconds=0),
+        video_length: Optional[timedelta] = None,
+        preview: bool = False,
+        preview_at: Optional[timedelta] = None,
+        preview_lap: Optional[int] = None,
+        preview_length: timedelta = timedelta(seconds=20),
+        preview_scale: float = 0.25,
+        preview_fps: float = 10.0,
+        panel_folder: str = "panel",
+    ) -> None:
+        self.fit_file = fit_file
+        self.video_files = video_files
+        self.video_output_path = video_output_path
+        self.video_lap_time = video_lap_time
+        self.lap_time_search_window = lap_time_search_window
+        self.render_config = render_config
+        self.video_offset = video_offset
+        self.video_length = video_length
+        self.preview = preview
+        self.preview_at = preview_at
+        self.preview_lap = preview_lap
+        self.preview_length = preview_length
+        self.preview_scale = preview_scale
+        self.preview_fps = preview_fps
+        self.panel_folder = panel_folder
+
+    @staticmethod
+    def from_args(args: Dict[str, Any]) -> "RenderJob":
+        """
+        Build a job from the options of the render subcommand, e.g. parsed CLI
+        arguments or a JSON job sent to the render service. The render config
+        can be given inline as render_config instead of render_config_file.
+        """
+        from config import load_render_config
+
+        def seconds(key: str) -> Optional[timedelta]:
+            value = args.get(key)
+            return None if value is None else timedelta(seconds=value)
+
+        render_config = args.get("render_config")
+        if render_config is None:
+            render_config = load_render_config(args["render_config_file"])
+
+        left_search_bound, right_search_bound = args["lap_time_search_window_in_secs"]
+
+        return RenderJob(
+            fit_file=args["fit_file"],
+            video_files=args["video_files"],
+            video_output_path=args["video_output_path"],
+            video_lap_time=timedelta(seconds=args["video_lap_time_in_secs"]),
+            lap_time_search_window=(
+                timedelta(seconds=left_search_bound),
+                timedelta(seconds=right_search_bound),
+            ),
+            render_config=render_config,
+            video_offset=timedelta(seconds=args.get("video_offset_start_in_secs", 0.0)),
+            video_length=seconds("video_length_in_secs"),
+            preview=args.get("preview", False),
+            preview_at=seconds("preview_at_in_secs"),
+            preview_lap=args.get("preview_lap"),
+            preview_length=timedelta(seconds=args.get("preview_length_in_secs", 20.0)),
+            preview_scale=args.get("preview_scale", 0.25),
+            preview_fps=args.get("preview_fps", 10.0),
+            panel_folder=args.get("panel_folder", "panel"),
+        )
+
+
+class PreparedRender:
+    """A job after alignment, with the exact window and outputs to render."""
+
+    def __init__(
+        self,
+        job: RenderJob,
+        video: GoProVideo,
+        garmin_segment: GarminSegment,
+        garmin_start_time: datetime,
+        video_offset: timedelta,
+        video_length: timedelta,
+        outputs: List[Any],
+        fps: float,
+        panel_folder: Optional[str] = None,
+    ) -> None:
+        self.job = job
+        self.video = video
+        self.garmin_segment = garmin_segment
+        self.garmin_start_time = garmin_start_time
+        self.video_offset = video_offset
+        self.video_length = video_length
+        self.outputs = outputs
+        self.fps = fps
+        self.panel_folder = (
+            panel_folder if panel_folder is not None else job.panel_folder
+        )
+
+
+class HighlightWindow:
+    """A clip around a manual lap, counting laps from 1 like --preview-lap."""
+
+    def __init__(self, lap: int, pre_roll: timedelta, post_roll: timedelta) -> None:
+        self.lap = lap
+        self.pre_roll = pre_roll
+        self.post_roll = post_roll
+
+
+@functools.cache
+def _load_video(video_files: Tuple[str, ...]) -> GoProVideo:
+    return GoProVideo(list(video_files))
+
+
+def load_video(video_files: List[str]) -> GoProVideo:
+    return _load_video(tuple(video_files))
+
+
+@functools.lru_cache(maxsize=MAX_CACHED_GARMIN_SEGMENTS)
+def _load_garmin_segment(path: str, modified_time: float) -> GarminSegment:
+    garmin_segment = GarminSegment.load_from_file(path)
+    # shared by every job on this file, as none of them depend on the job
+    garmin_segment.add_derived_metrics()
+    return garmin_segment
+
+
+def load_garmin_segment(fit_file: str) -> GarminSegment:
+    """A decoded FIT file with derived metrics, decoded again once it changes."""
+    return _load_garmin_segment(
+        os.path.abspath(fit_file), os.path.getmtime(fit_file)
+    )
+
+
+def align(
+    video: GoProVideo,
+    garmin_segment: GarminSegment,
+    video_lap_time: timedelta,
+    lap_time_search_window: Tuple[timedelta, timedelta],
+) -> timedelta:
+    garmin_time_shift = get_garmin_time_shift(
+        video, garmin_segment, video_lap_time, *lap_time_search_window
+    )
+    if garmin_time_shift is None:
+        raise AlignmentError("Could not find a Garmin lap to align the video with")
+    return garmin_time_shift
+
+
+def _load_and_align(job: RenderJob) -> Tuple[GoProVideo, GarminSegment, timedelta]:
+    video = load_video(job.video_files)
+
+    garmin_segment = load_garmin_segment(job.fit_file)
+
+    garmin_time_shift = align(
+        video, garmin_segment, job.video_lap_time, job.lap_time_search_window
+    )
+    return video, garmin_segment, garmin_time_shift
+
+
+def prepare(job: RenderJob) -> PreparedRender:
+    from config import get_render_outputs, get_preview_outputs
+
+    video, garmin_segment, garmin_time_shift = _load_and_align(job)
+
+    video_offset = job.video_offset
+    video_length = (
+        job.video_length if job.video_length is not None else video.get_duration()
+    )
+    outputs = get_render_outputs(
+        job.render_config, job.video_output_path, video.get_resolution()
+    )
+    fps = video.get_fps()
+
+    if job.preview:
+        preview_center = video_offset
+        if job.preview_lap is not None:
+            laps = garmin_segment.get_manual_laps()
+            assert (
+                1 <= job.preview_lap <= len(laps)
+            ), f"There is no manual lap {job.preview_lap}, the ride has {len(laps)}"
+            preview_lap = laps[job.preview_lap - 1]
+            preview_center = (
+                preview_lap.start_time - garmin_time_shift - video.get_start_time()
+            )
+            if not timedelta(seconds=0) <= preview_center <= video.get_duration():
+                message = f"Lap {job.preview_lap} is not in the video"
+                print(f"{message}.")
+                raise AlignmentError(message)
+        elif job.preview_at is not None:
+            preview_center = job.preview_at
+        preview_center = min(
+            max(timedelta(seconds=0), preview_center), video.get_duration()
+        )
+
+        video_offset = max(
+            timedelta(seconds=0), preview_center - (job.preview_length / 2)
+        )
+        video_length = min(job.preview_length, video.get_duration() - video_offset)
+        outputs = get_preview_outputs(outputs, job.preview_scale)
+        fps = job.preview_fps
+        print(f"Rendering preview of {video_length} starting at {video_offset}.")
+
+    garmin_start_time = video.get_start_time() + video_offset + garmin_time_shift
+    print(f"Garmin start time: {garmin_start_time}\n")
+
+    return PreparedRender(
+        job=job,
+        video=video,
+        garmin_segment=garmin_segment,
+        garmin_start_time=garmin_start_time,
+        video_offset=video_offset,
+        video_length=video_length,
+        outputs=outputs,
+        fps=fps,
+    )
+
+
+def render(
+    prepared: PreparedRender,
+    worker_pool: Optional[Any] = None,
+    progress: Optional[Callable[[str, float], None]] = None,
+) -> Dict[str, float]:
+    """
+    Render the panels and the video of a prepared job and return timing metrics.
+    A running multiprocessing pool can be passed in to skip starting workers,
+    and progress is called with the current stage and its completed fraction.
+    """
+    from render import ThreadedPanelRenderer, VideoRenderer
+    from config import assign_panel_folders, get_panel_renderer_options
+    from resources import resolve_thread_counts
+
+    render_config = prepared.job.render_config
+    panels_to_render = assign_panel_folders(prepared.outputs, prepared.panel_folder)
+    panel_threads, video_threads = resolve_thread_counts(
+        render_config,
+        [
+            (output.resolution, output.panel_config["panelWidth"])
+            for output in panels_to_render
+        ],
+        prepared.garmin_segment.coordinates,
+        int(prepared.video_length.total_seconds() * prepared.fps),
+    )
+
+    def report(stage: str, fraction: float) -> None:
+        if progress is not None:
+            progress(stage, fraction)
+
+    print("Rendering side panels...")
+
+    render_start_time = time.time()
+    num_frames = 0
+
+    for index, output in enumerate(panels_to_render):
+        renderer = ThreadedPanelRenderer(
+            segment=prepared.garmin_segment,
+            segment_start_time=prepared.garmin_start_time,
+            video_length=prepared.video_length,
+            video=prepared.video,
+            output_folder=output.panel_folder,
+            num_threads=panel_threads,
+            resolution=output.resolution,
+            fps=prepared.fps,
+            panel_format=render_config.get("panelFormat"),
+            rider_weight=render_config.get("riderWeight"),
+            **get_panel_renderer_options(output.panel_config),
+        )
+        renderer.render(
+            worker_pool=worker_pool,
+            progress=lambda fraction: report(
+                "panels", (index + fraction) / len(panels_to_render)
+            ),
+        )
+        num_frames += len(renderer.video_segment.coordinates)
+
+    panel_end_time = time.time()
+
+    print("Rendering video...")
+    report("video", 0.0)
+
+    VideoRenderer(
+        video=prepared.video,
+        outputs=prepared.outputs,
+        num_threads=video_threads,
+        video_length=prepared.video_length,
+        video_offset=prepared.video_offset,
+        audio=render_config.get("audio", "copy"),
+        fps=prepared.fps,
+        panel_format=render_config.get("panelFormat"),
+    ).render()
+
+    render_end_time = time.time()
+    report("video", 1.0)
+
+    panel_seconds = panel_end_time - render_start_time
+    return {
+        "panelFrames": num_frames,
+        "panelSecs": panel_seconds,
+        "panelFps": num_frames / panel_seconds if panel_seconds > 0 else 0.0,
+        "videoSecs": render_end_time - panel_end_time,
+        "totalSecs": render_end_time - render_start_time,
+    }
+
+
+def prepare_highlights(
+    job: RenderJob,
+    windows: Optional[List[HighlightWindow]] = None,
+    pre_roll: timedelta = timedelta(seconds=5),
+    post_roll: timedelta = timedelta(seconds=10),
+) -> List[PreparedRender]:
+    """
+    One prepared render per highlight window, all sharing the probed video, the
+    decoded segment and a single alignment. Without windows, every manual lap
+    becomes a clip with the given pre and post roll. Clips are written next to
+    the output path with a -lap<N> suffix.
+    """
+    from config import get_render_outputs
+
+    video, garmin_segment, garmin_time_shift = _load_and_align(job)
+    laps = garmin_segment.get_manual_laps()
+    if windows is None:
+        windows = [
+            HighlightWindow(lap, pre_roll, post_roll) for lap in range(1, len(laps) + 1)
+        ]
+
+    # clip files and panel folders are named after their lap
+    window_laps = [window.lap for window in windows]
+    repeated_laps = sorted({lap for lap in window_laps if window_laps.count(lap) > 1})
+    assert len(repeated_laps) == 0, f"More than one clip of laps {repeated_laps}"
+
+    root, extension = os.path.splitext(job.video_output_path)
+    clips = []
+    for window in windows:
+        assert 1 <= window.lap <= len(laps), f"There is no manual lap {window.lap}"
+        lap_time = (
+            laps[window.lap - 1].start_time - garmin_time_shift - video.get_start_time()
+        )
+        video_offset = max(timedelta(seconds=0), lap_time - window.pre_roll)
+        video_end = min(video.get_duration(), lap_time + window.post_roll)
+        if video_end <= video_offset:
+            print(f"Skipping lap {window.lap}, it is not in the video.")
+            continue
+
+        clips.append(
+            PreparedRender(
+                job=job,
+                video=video,
+                garmin_segment=garmin_segment,
+                garmin_start_time=(
+                    video.get_start_time() + video_offset + garmin_time_shift
+                ),
+                video_offset=video_offset,
+                video_length=video_end - video_offset,
+                outputs=get_render_outputs(
+                    job.render_config,
+                    f"{root}-lap{window.lap}{extension}",
+                    video.get_resolution(),
+                ),
+                fps=video.get_fps(),
+                panel_folder=f"{job.panel_folder}-lap{window.lap}",
+            )
+        )
+        print(
+            f"Clip of lap {window.lap}: {video_end - video_offset} "
+            f"starting at {video_offset}."
+        )
+
+    return clips
+
+
+def render_highlights(
+    clips: List[PreparedRender],
+    reel: bool = False,
+    parallel_encodes: Optional[int] = None,
+    worker_pool: Optional[Any] = None,
+    progress: Optional[Callable[[str, float], None]] = None,
+) -> Dict[str, float]:
+    """
+    Render highlight clips in one go. The panels of every clip are rendered as a
+    single batch in one worker pool, then the clips are encoded in parallel,
+    each decoding only its own window of the source. With reel, the clips are
+    also joined into the outputs of the job without re-encoding.
+    """
+    from multiprocessing import pool
+    from render import ThreadedPanelRenderer, VideoRenderer, render_panels, concat_videos
+    from config import (
+        assign_panel_folders,
+        get_panel_renderer_options,
+        get_render_outputs,
+    )
+    from resources import resolve_thread_counts
+
+    assert len(clips) > 0, "No highlight clips to render"
+    job = clips[0].job
+    render_config = job.render_config
+
+    panels_to_render = [
+        (clip, output)
+        for clip in clips
+        for output in assign_panel_folders(clip.outputs, clip.panel_folder)
+    ]
+    # a worker renders one clip at a time, so size it for the longest clip
+    panel_threads, video_threads = resolve_thread_counts(
+        render_config,
+        [
+            (output.resolution, output.panel_config["panelWidth"])
+            for _, output in panels_to_render
+        ],
+        clips[0].garmin_segment.coordinates,
+        max(int(clip.video_length.total_seconds() * clip.fps) for clip in clips),
+    )
+
+    def report(stage: str, fraction: float) -> None:
+        if progress is not None:
+            progress(stage, fraction)
+
+    print(f"Rendering side panels of {len(clips)} clips...")
+
+    render_start_time = time.time()
+
+    renderers = [
+        ThreadedPanelRenderer(
+            segment=clip.garmin_segment,
+            segment_start_time=clip.garmin_start_time,
+            video_length=clip.video_length,
+            video=clip.video,
+            output_folder=output.panel_folder,
+            num_threads=panel_threads,
+            resolution=output.resolution,
+            fps=clip.fps,
+            panel_format=render_config.get("panelFormat"),
+            rider_weight=render_config.get("riderWeight"),
+            **get_panel_renderer_options(output.panel_config),
+        )
+        for clip, output in panels_to_render
+    ]
+    render_panels(
+        renderers,
+        worker_pool=worker_pool,
+        progress=lambda fraction: report("panels", fraction),
+    )
+    num_frames = sum(len(renderer.video_segment.coordinates) for renderer in renderers)
+
+    panel_end_time = time.time()
+
+    if parallel_encodes is None:
+        parallel_encodes = max(1, video_threads // MIN_THREADS_PER_ENCODE)
+    parallel_encodes = min(parallel_encodes, len(clips))
+
+    video_renderers = [
+        VideoRenderer(
+            video=clip.video,
+            outputs=clip.outputs,
+            num_threads=max(1, video_threads // parallel_encodes),
+            video_length=clip.video_length,
+            video_offset=clip.video_offset,
+            audio=render_config.get("audio", "copy"),
+            fps=clip.fps,
+            panel_format=render_config.get("panelFormat"),
+        )
+        for clip in clips
+    ]
+    if reel:
+        audio_modes = set(
+            renderer.get_audio_mode(
+                renderer.video_offset.total_seconds(),
+                (renderer.video_offset + renderer.video_length).total_seconds(),
+            )
+            for renderer in video_renderers
+        )
+        # the clips can only be joined without re-encoding if their audio
+        # streams match, which copied and re-encoded audio don't
+        if len(audio_modes) > 1:
+            for renderer in video_renderers:
+                renderer.audio = "encode"
+
+    print(f"Encoding {len(clips)} clips, {parallel_encodes} at a time...")
+    report("video", 0.0)
+
+    for finished, _ in enumerate(
+        pool.ThreadPool(parallel_encodes).imap_unordered(
+            VideoRenderer.render, video_renderers
+        )
+    ):
+        report("video", (finished + 1) / len(clips))
+
+    if reel:
+        outputs = get_render_outputs(
+            render_config, job.video_output_path, clips[0].video.get_resolution()
+        )
+        for index, output in enumerate(outputs):
+            concat_videos(
+                [clip.outputs[index].filepath for clip in clips], output.filepath
+            )
+
+    render_end_time = time.time()
+
+    panel_seconds = panel_end_time - render_start_time
+    return {
+        "clips": len(clips),
+        "panelFrames": num_frames,
+        "panelSecs": panel_seconds,
+        "panelFps": num_frames / panel_seconds if panel_seconds > 0 else 0.0,
+        "videoSecs": render_end_time - panel_end_time,
+        "totalSecs": render_end_time - render_start_time,
+    }
+
+
+def write_shard_manifest(prepared: PreparedRender, num_shards: int, work_dir: str) -> str:
+    from shard import write_manifest
+
+    return write_manifest(
+        work_dir=work_dir,
+        num_shards=num_shards,
+        video=prepared.video,
+        garmin_segment=prepared.garmin_segment,
+        garmin_start_time=prepared.garmin_start_time,
+        video_offset=prepared.video_offset,
+        video_length=prepared.video_length,
+        video_output_path=prepared.job.video_output_path,
+        render_config=prepared.job.render_config,
+    )
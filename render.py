@@ -1,16 +1,19 @@
 from datetime import timedelta, datetime
-from coordinate import GarminSegment, GarminCoordinate, Speed
-import matplotlib.pyplot as plt
+from coordinate import GarminSegment, GarminCoordinate, Speed, get_monotonic_distances
 import numpy as np
 import matplotlib.patches as patches
 from matplotlib.path import Path
-from typing import Any, Tuple, List, Dict
+from typing import Any, Callable, Tuple, List, Dict, Optional
 from video import GoProVideo
+from config import RenderOutput
 from multiprocessing import pool
 import os
 import shutil
+import tempfile
 import ffmpeg
-from matplotlib import font_manager, use
+from matplotlib import font_manager
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 
 STATS_FONT = font_manager.FontProperties(fname="fonts/Orbitron-Black.ttf")
@@ -20,6 +23,444 @@ class Renderer:
     pass
 
 
+def simplify_polyline(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """Douglas-Peucker simplification of an (n, 2) array of points."""
+    if len(points) < 3:
+        return points
+
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+
+        direction = points[end] - points[start]
+        offsets = points[start + 1 : end] - points[start]
+        length = np.hypot(direction[0], direction[1])
+        if length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = (
+                np.abs(direction[0] * offsets[:, 1] - direction[1] * offsets[:, 0])
+                / length
+            )
+
+        index = int(np.argmax(distances))
+        if distances[index] > tolerance:
+            split = start + 1 + index
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+
+    return points[keep]
+
+
+class RouteLayer:
+    """
+    The route drawn once into an RGBA image the size of the map axis.
+
+    The route is simplified in pixel space before it is stroked, so the cost
+    of building the layer is bounded by the map size rather than the ride length,
+    and every frame only has to composite a fixed size image.
+    """
+
+    # TODO: move spacing to config file
+    MARGIN = 0.1
+    LINE_WIDTH = 6
+
+    def __init__(
+        self,
+        longitudes: np.ndarray,
+        latitudes: np.ndarray,
+        width: int,
+        height: int,
+        opacity: float,
+        tolerance: float = 0.5,
+        line_width_scale: float = 1.0,
+    ) -> None:
+        min_x, max_x = float(np.min(longitudes)), float(np.max(longitudes))
+        min_y, max_y = float(np.min(latitudes)), float(np.max(latitudes))
+        dx, dy = max_x - min_x, max_y - min_y
+
+        self.xlim = (min_x - (dx * self.MARGIN), max_x + (dx * self.MARGIN))
+        self.ylim = (min_y - (dy * self.MARGIN), max_y + (dy * self.MARGIN))
+        self.width = width
+        self.height = height
+
+        pixels = self._to_pixels(longitudes, latitudes)
+        self.pixels = simplify_polyline(pixels, tolerance)
+        self.image = self._rasterize(opacity, self.LINE_WIDTH * line_width_scale)
+
+    @staticmethod
+    def from_segment(
+        segment: GarminSegment,
+        width: int,
+        height: int,
+        opacity: float,
+        line_width_scale: float = 1.0,
+    ) -> "RouteLayer":
+        longitudes = np.array([c.longitude for c in segment.coordinates])
+        latitudes = np.array([c.latitude for c in segment.coordinates])
+        return RouteLayer(
+            longitudes,
+            latitudes,
+            width,
+            height,
+            opacity,
+            line_width_scale=line_width_scale,
+        )
+
+    def get_extent(self) -> Tuple[float, float, float, float]:
+        return (*self.xlim, *self.ylim)
+
+    def _to_pixels(self, longitudes: np.ndarray, latitudes: np.ndarray) -> np.ndarray:
+        x_span = (self.xlim[1] - self.xlim[0]) or 1.0
+        y_span = (self.ylim[1] - self.ylim[0]) or 1.0
+        pixels = np.column_stack(
+            (
+                (longitudes - self.xlim[0]) / x_span * self.width,
+                (latitudes - self.ylim[0]) / y_span * self.height,
+            )
+        )
+
+        # consecutive points landing on the same pixel add nothing to the stroke
+        rounded = np.round(pixels)
+        changed = np.ones(len(pixels), dtype=bool)
+        changed[1:] = np.any(rounded[1:] != rounded[:-1], axis=1)
+        changed[-1] = True
+        return pixels[changed]
+
+    def _rasterize(self, opacity: float, line_width: float) -> np.ndarray:
+        figure = Figure(
+            frameon=False, dpi=100, figsize=(self.width / 100, self.height / 100)
+        )
+        canvas = FigureCanvasAgg(figure)
+        axis = figure.add_axes([0, 0, 1, 1])
+        axis.axis("off")
+        axis.set_xlim(0, self.width)
+        axis.set_ylim(0, self.height)
+
+        codes = [Path.MOVETO] + [Path.LINETO for _ in range(len(self.pixels) - 1)]
+        patch = patches.PathPatch(
+            Path(self.pixels, codes),
+            edgecolor=(1, 1, 1, opacity),
+            facecolor="none",
+            lw=line_width,
+            joinstyle="round",
+            capstyle="round",
+        )
+        axis.add_patch(patch)
+
+        canvas.draw()
+        return np.asarray(canvas.buffer_rgba()).copy()
+
+
+class ElevationLayer:
+    """
+    The elevation profile of the route drawn once into an RGBA image the size of
+    the elevation axis.
+
+    Altitude is resampled to one value per pixel column before it is drawn, so
+    the layer costs the same for any ride length, and frames only have to move
+    a cursor along it.
+    """
+
+    MARGIN = 0.1
+    # room above the profile for the grade text
+    TOP_MARGIN = 0.6
+    LINE_WIDTH = 4
+    FILL_OPACITY = 0.3
+
+    def __init__(
+        self,
+        distances: np.ndarray,
+        altitudes: np.ndarray,
+        width: int,
+        height: int,
+        opacity: float,
+        line_width_scale: float = 1.0,
+    ) -> None:
+        known = ~np.isnan(altitudes)
+        if not np.any(known):
+            distances, altitudes = np.array([0.0]), np.array([0.0])
+        else:
+            distances = get_monotonic_distances(distances)[known]
+            altitudes = altitudes[known]
+
+        min_y, max_y = float(np.min(altitudes)), float(np.max(altitudes))
+        dy = (max_y - min_y) or 1.0
+
+        self.xlim = (float(distances[0]), float(max(distances[-1], distances[0] + 1)))
+        self.ylim = (min_y - (dy * self.MARGIN), max_y + (dy * self.TOP_MARGIN))
+        self.width = width
+        self.height = height
+
+        self.column_distances = np.linspace(*self.xlim, max(width, 2))
+        self.column_altitudes = np.interp(self.column_distances, distances, altitudes)
+        self.image = self._rasterize(opacity, self.LINE_WIDTH * line_width_scale)
+
+    @staticmethod
+    def from_segment(
+        segment: GarminSegment,
+        width: int,
+        height: int,
+        opacity: float,
+        line_width_scale: float = 1.0,
+    ) -> "ElevationLayer":
+        return ElevationLayer(
+            segment.get_record_array("distance"),
+            segment.get_record_array("altitude"),
+            width,
+            height,
+            opacity,
+            line_width_scale=line_width_scale,
+        )
+
+    def get_extent(self) -> Tuple[float, float, float, float]:
+        return (*self.xlim, *self.ylim)
+
+    def get_altitude(self, distance: float) -> float:
+        """Altitude of the drawn profile, so the cursor always sits on the line."""
+        return float(np.interp(distance, self.column_distances, self.column_altitudes))
+
+    def _rasterize(self, opacity: float, line_width: float) -> np.ndarray:
+        figure = Figure(
+            frameon=False, dpi=100, figsize=(self.width / 100, self.height / 100)
+        )
+        canvas = FigureCanvasAgg(figure)
+        axis = figure.add_axes([0, 0, 1, 1])
+        axis.axis("off")
+        axis.set_xlim(*self.xlim)
+        axis.set_ylim(*self.ylim)
+
+        axis.fill_between(
+            self.column_distances,
+            self.ylim[0],
+            self.column_altitudes,
+            facecolor=(1, 1, 1, opacity * self.FILL_OPACITY),
+            edgecolor="none",
+        )
+        axis.plot(
+            self.column_distances,
+            self.column_altitudes,
+            color=(1, 1, 1, opacity),
+            lw=line_width,
+            solid_joinstyle="round",
+            solid_capstyle="round",
+        )
+
+        canvas.draw()
+        return np.asarray(canvas.buffer_rgba()).copy()
+
+
+def get_panel_figsize(resolution: Tuple[int, int], panel_width: float) -> Tuple[float, float]:
+    width, height = resolution
+    return (width / 100) * panel_width, (height / 100)
+
+
+def get_panel_size(resolution: Tuple[int, int], panel_width: float) -> Tuple[int, int]:
+    """Size in pixels of the panel frames, exactly as Agg will render them."""
+    figure = Figure(
+        frameon=False, dpi=100, figsize=get_panel_figsize(resolution, panel_width)
+    )
+    return FigureCanvasAgg(figure).get_width_height()
+
+
+class PanelFrameStore:
+    """
+    Where rendered panel frames are spooled for the video renderer. Frames are
+    numbered by their position in the video and are stored either as PNG files
+    with a configurable compression level, as QOI files, or uncompressed in a
+    single preallocated memory-mapped RGBA file.
+    """
+
+    FORMATS = ["png", "qoi", "raw"]
+    RAW_FILENAME = "frames.rgba"
+
+    def __init__(
+        self,
+        folder: str,
+        size: Tuple[int, int],
+        format: str = "png",
+        compression_level: int = 6,
+    ) -> None:
+        assert format in self.FORMATS
+        self.folder = folder
+        self.size = size
+        self.format = format
+        self.compression_level = compression_level
+        self.num_frames: Optional[int] = None
+        self.frames: Optional[np.memmap] = None
+
+    @staticmethod
+    def from_config(
+        folder: str, size: Tuple[int, int], panel_format: Optional[Dict[str, Any]]
+    ) -> "PanelFrameStore":
+        panel_format = panel_format or {}
+        return PanelFrameStore(
+            folder,
+            size,
+            format=panel_format.get("type", "png"),
+            compression_level=panel_format.get("compressionLevel", 6),
+        )
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # every worker maps the raw file itself
+        return {**self.__dict__, "frames": None}
+
+    def get_raw_path(self) -> str:
+        return os.path.join(self.folder, self.RAW_FILENAME)
+
+    def get_frame_pattern(self) -> str:
+        return os.path.join(self.folder, f"%08d.{self.format}")
+
+    def create(self, num_frames: int) -> None:
+        if os.path.exists(self.folder):
+            shutil.rmtree(self.folder)
+        os.makedirs(self.folder, exist_ok=True)
+
+        self.num_frames = num_frames
+        if self.format == "raw":
+            width, height = self.size
+            with open(self.get_raw_path(), "wb") as raw_file:
+                raw_file.truncate(num_frames * height * width * 4)
+
+    def write(self, frame: int, figure: Figure) -> None:
+        if self.format == "png":
+            figure.savefig(
+                self.get_frame_pattern() % frame,
+                transparent=True,
+                pil_kwargs={"compress_level": self.compression_level},
+            )
+            return
+
+        figure.canvas.draw()
+        image = np.asarray(figure.canvas.buffer_rgba())
+        assert image.shape[1::-1] == self.size
+
+        if self.format == "qoi":
+            try:
+                import qoi
+            except ImportError:
+                raise ImportError("The qoi panel format needs the qoi package")
+            qoi.write(self.get_frame_pattern() % frame, np.ascontiguousarray(image))
+        else:
+            if self.frames is None:
+                width, height = self.size
+                self.frames = np.memmap(
+                    self.get_raw_path(),
+                    dtype=np.uint8,
+                    mode="r+",
+                    shape=(self.num_frames, height, width, 4),
+                )
+            self.frames[frame] = image
+
+    def close(self) -> None:
+        if self.frames is not None:
+            self.frames.flush()
+            self.frames = None
+
+    def get_input(self, fps: float):
+        if self.format == "raw":
+            width, height = self.size
+            return ffmpeg.input(
+                self.get_raw_path(),
+                f="rawvideo",
+                pix_fmt="rgba",
+                s=f"{width}x{height}",
+                framerate=fps,
+            )
+        options = {"vcodec": "qoi"} if self.format == "qoi" else {}
+        return ffmpeg.input(
+            self.get_frame_pattern(), f="image2", framerate=fps, **options
+        )
+
+
+class StatTextTable:
+    """
+    Display strings for every stat on every frame of the video, formatted in one
+    vectorized pass before any worker starts.
+
+    Whether a stat's text changes is kept for every frame, so renderers only
+    touch the text artists that actually change.
+    """
+
+    UNIT_CONVERSIONS = {
+        "mph": Speed.SECONDS_IN_HOUR / Speed.METERS_IN_MILE,
+        "kph": Speed.SECONDS_IN_HOUR / 1000,
+        "mps": 1.0,
+    }
+    DECIMAL_PLACES = {"watts_per_kg": 1}
+    KEYS = (
+        GarminCoordinate.RECORD_KEYS
+        + GarminCoordinate.DERIVED_METRIC_KEYS
+        + ("watts_per_kg",)
+    )
+
+    def __init__(
+        self,
+        coordinates: List[GarminCoordinate],
+        stat_keys_and_labels: List[Tuple[str, str]],
+        rider_weight: Optional[float] = None,
+    ) -> None:
+        unknown_keys = [key for key, _ in stat_keys_and_labels if key not in self.KEYS]
+        assert len(unknown_keys) == 0, f"Unknown stat keys {unknown_keys}"
+
+        self.num_frames = len(coordinates)
+        self.texts: Dict[str, np.ndarray] = {}
+        self.changes: Dict[str, np.ndarray] = {}
+
+        for key, label in stat_keys_and_labels:
+            values = self._get_values(coordinates, key, label, rider_weight)
+            if key in self.DECIMAL_PLACES:
+                texts = np.char.mod(f"%.{self.DECIMAL_PLACES[key]}f", values)
+            else:
+                texts = np.trunc(values).astype(np.int64).astype(str)
+
+            changes = np.ones(self.num_frames, dtype=bool)
+            changes[1:] = texts[1:] != texts[:-1]
+
+            self.texts[key] = texts
+            self.changes[key] = changes
+
+    def get_text(self, key: str, frame: int) -> str:
+        return str(self.texts[key][frame])
+
+    def get_changed_keys(self, frame: int) -> List[str]:
+        return [key for key, changes in self.changes.items() if changes[frame]]
+
+    @classmethod
+    def _get_values(
+        cls,
+        coordinates: List[GarminCoordinate],
+        key: str,
+        label: str,
+        rider_weight: Optional[float] = None,
+    ) -> np.ndarray:
+        if key == "watts_per_kg":
+            # the rider weight can differ between renders of the same ride
+            if not rider_weight:
+                return np.zeros(len(coordinates))
+            return cls._get_values(coordinates, "power_3s", label) / rider_weight
+
+        raw_values = [coordinate.__dict__.get(key) for coordinate in coordinates]
+        first = next((value for value in raw_values if value is not None), None)
+
+        if type(first) is Speed:
+            raw_values = [
+                None if value is None else value.get_meters_per_second()
+                for value in raw_values
+            ]
+            conversion = cls.UNIT_CONVERSIONS.get(label.lower(), 1.0)
+        else:
+            conversion = 1.0
+
+        values = np.array(raw_values, dtype=float) * conversion
+        return np.nan_to_num(values, nan=0.0, posinf=0.0, neginf=0.0)
+
+
 class ThreadedPanelRenderer(Renderer):
     def __init__(
         self,
@@ -43,6 +484,17 @@ class ThreadedPanelRenderer(Renderer):
         label_font_size: int,
         stats_opacity: float,
         num_threads: int,
+        resolution: Optional[Tuple[int, int]] = None,
+        route_start_time: Optional[datetime] = None,
+        route_length: Optional[timedelta] = None,
+        fps: Optional[float] = None,
+        panel_format: Optional[Dict[str, Any]] = None,
+        elevation_height: float = 0.0,
+        elevation_opacity: float = 1.0,
+        elevation_cursor_size: int = 0,
+        elevation_font_size: int = 0,
+        rider_weight: Optional[float] = None,
+        line_width_scale: float = 1.0,
     ) -> None:
         self.segment = segment
         self.segment_start_time = segment_start_time
@@ -63,44 +515,132 @@ class ThreadedPanelRenderer(Renderer):
         self.font_size = font_size
         self.label_font_size = label_font_size
         self.stats_opacity = stats_opacity
+        # no elevation profile is drawn at a height of 0
+        self.elevation_height = elevation_height
+        self.elevation_opacity = elevation_opacity
+        self.elevation_cursor_size = elevation_cursor_size
+        self.elevation_font_size = elevation_font_size
+        # for watts per kg, the weight of the FIT user profile when not given
+        self.rider_weight = segment.get_rider_weight(rider_weight)
+        self.line_width_scale = line_width_scale
         self.num_threads = num_threads
+        self.resolution = (
+            resolution if resolution is not None else video.get_resolution()
+        )
+        # the map shows the route of the whole video even when only part of it
+        # is rendered, e.g. for a single shard
+        self.route_start_time = route_start_time
+        self.route_length = route_length
+        self.fps = fps if fps is not None else video.get_fps()
+        self.frame_store = PanelFrameStore.from_config(
+            output_folder, get_panel_size(self.resolution, panel_width), panel_format
+        )
 
-    def clean_output_folder(self) -> None:
-        if os.path.exists(self.output_folder):
-            shutil.rmtree(self.output_folder)
-        os.makedirs(self.output_folder, exist_ok=True)
+    def render(
+        self,
+        worker_pool: Optional[pool.Pool] = None,
+        progress: Optional[Callable[[float], None]] = None,
+    ) -> None:
+        render_panels([self], worker_pool, progress)
 
-    def render(self) -> None:
-        self.clean_output_folder()
+    def get_tasks(self) -> List[Tuple[int, int, GarminSegment, GarminSegment]]:
+        """Prepare the shared layers and split the frames into one task per thread."""
         subsegments = []
         self.video_segment = self.segment.get_subsegment(
             self.segment_start_time,
             self.segment_start_time + self.video_length,
-            timedelta(seconds=1 / self.video.get_fps()),
+            timedelta(seconds=1 / self.fps),
+        )
+        self.frame_store.create(len(self.video_segment.coordinates))
+
+        route_segment = self.video_segment
+        if self.route_start_time is not None and self.route_length is not None:
+            route_segment = self.segment.get_subsegment(
+                self.route_start_time,
+                self.route_start_time + self.route_length,
+                timedelta(seconds=1),
+            )
+
+        width, height = self.resolution
+        self.route_layer = RouteLayer.from_segment(
+            route_segment,
+            width=round(width * self.panel_width),
+            height=round(height * self.map_height),
+            opacity=self.map_opacity,
+            line_width_scale=self.line_width_scale,
+        )
+        self.stat_text_table = StatTextTable(
+            self.video_segment.coordinates, self.stat_keys_and_labels, self.rider_weight
         )
 
+        self.elevation_layer = None
+        self.grade_text_table = None
+        if self.elevation_height > 0:
+            self.elevation_layer = ElevationLayer.from_segment(
+                route_segment,
+                width=round(width * self.panel_width),
+                height=round(height * self.elevation_height),
+                opacity=self.elevation_opacity,
+                line_width_scale=self.line_width_scale,
+            )
+            self.grade_text_table = StatTextTable(
+                self.video_segment.coordinates, [("gradient", "%")]
+            )
+
+        frame_offset = 0
         for thread, subsegment_coordinates in enumerate(
             np.array_split(self.video_segment.coordinates, self.num_threads)
         ):
             subsegments.append(
-                (thread, self.video_segment, GarminSegment(subsegment_coordinates))
+                (
+                    thread,
+                    frame_offset,
+                    self.video_segment,
+                    GarminSegment(subsegment_coordinates),
+                )
             )
+            frame_offset += len(subsegment_coordinates)
 
-        pool.Pool(self.num_threads).map(self.render_with_single_thread, subsegments)
+        return subsegments
 
     def render_with_single_thread(self, args):
-        thread_number, video_segment, subsegment = args
+        thread_number, frame_offset, video_segment, subsegment = args
         renderer = PanelRenderer(
             **{
                 **self.__dict__,
                 "segment": video_segment,
                 "subsegment": subsegment,
                 "thread_number": thread_number,
+                "frame_offset": frame_offset,
             },
         )
         renderer.render()
 
 
+def _render_panel_task(task) -> None:
+    renderer, args = task
+    renderer.render_with_single_thread(args)
+
+
+def render_panels(
+    renderers: List[ThreadedPanelRenderer],
+    worker_pool: Optional[pool.Pool] = None,
+    progress: Optional[Callable[[float], None]] = None,
+) -> None:
+    """
+    Render the panels of several renderers, e.g. the clips of a highlight reel,
+    as one batch of tasks, so workers never wait for the slowest task of a clip.
+    """
+    tasks = [(renderer, args) for renderer in renderers for args in renderer.get_tasks()]
+
+    if worker_pool is None:
+        worker_pool = pool.Pool(max(renderer.num_threads for renderer in renderers))
+
+    for finished, _ in enumerate(worker_pool.imap_unordered(_render_panel_task, tasks)):
+        if progress is not None:
+            progress((finished + 1) / len(tasks))
+
+
 class PanelRenderer(Renderer):
     def __init__(
         self,
@@ -109,6 +649,7 @@ class PanelRenderer(Renderer):
         video: GoProVideo,
         output_folder: str,
         thread_number: int,
+        frame_offset: int,
         panel_width: float,
         map_height: float,
         map_opacity: float,
@@ -123,6 +664,16 @@ class PanelRenderer(Renderer):
         font_size: int,
         label_font_size: int,
         stats_opacity: float,
+        route_layer: RouteLayer,
+        stat_text_table: StatTextTable,
+        resolution: Tuple[int, int],
+        frame_store: PanelFrameStore,
+        elevation_height: float = 0.0,
+        elevation_cursor_size: int = 0,
+        elevation_font_size: int = 0,
+        elevation_opacity: float = 1.0,
+        elevation_layer: Optional[ElevationLayer] = None,
+        grade_text_table: Optional[StatTextTable] = None,
         **_,
     ) -> None:
         self.segment = segment
@@ -130,6 +681,7 @@ class PanelRenderer(Renderer):
         self.video = video
         self.output_folder = output_folder
         self.thread_number = thread_number
+        self.frame_offset = frame_offset
         self.panel_width = panel_width
         self.map_height = map_height
         self.map_opacity = map_opacity
@@ -144,25 +696,35 @@ class PanelRenderer(Renderer):
         self.font_size = font_size
         self.label_font_size = label_font_size
         self.stats_opacity = stats_opacity
+        self.route_layer = route_layer
+        self.stat_text_table = stat_text_table
+        self.resolution = resolution
+        self.frame_store = frame_store
+        self.elevation_height = elevation_height
+        self.elevation_cursor_size = elevation_cursor_size
+        self.elevation_font_size = elevation_font_size
+        self.elevation_opacity = elevation_opacity
+        self.elevation_layer = elevation_layer
+        self.grade_text_table = grade_text_table
         self.make_figure()
 
         # for now, let's keep the map static
         # and only render it once
         self.plot_map()
         self.plot_marker()
+        if self.elevation_layer is not None:
+            self.plot_elevation()
         self.plot_stats()
 
     def make_figure(self) -> None:
-        width, height = self.video.get_resolution()
-        use('Agg')
-        figure = plt.figure(
+        # not registered with pyplot, so the figure is freed with the renderer
+        # instead of living on in a long running worker
+        figure = Figure(
             frameon=False,
             dpi=100,
-            figsize=(
-                (width / 100) * self.panel_width,
-                (height / 100),
-            ),
+            figsize=get_panel_figsize(self.resolution, self.panel_width),
         )
+        FigureCanvasAgg(figure)
         self.figure = figure
 
     def plot_map(self) -> None:
@@ -171,28 +733,14 @@ class PanelRenderer(Renderer):
         )
         self.map_axis.axis("off")
 
-        verts = [(c.longitude, c.latitude) for c in self.segment.coordinates]
-        codes = [Path.MOVETO] + [Path.CURVE3 for _ in range(len(verts) - 1)]
-        path = Path(verts + [verts[-1]], codes + [Path.MOVETO])
-        patch = patches.PathPatch(
-            path,
-            edgecolor=(1, 1, 1, self.map_opacity),
-            facecolor="none",
-            lw=6,
+        self.map_axis.imshow(
+            self.route_layer.image,
+            extent=self.route_layer.get_extent(),
+            interpolation="none",
+            aspect="auto",
         )
-
-        xs = [vert[0] for vert in verts]
-        ys = [vert[1] for vert in verts]
-
-        min_x, max_x = min(xs), max(xs)
-        min_y, max_y = min(ys), max(ys)
-
-        dx, dy = max_x - min_x, max_y - min_y
-
-        self.map_axis.add_patch(patch)
-        # TODO: move spacing to config file
-        self.map_axis.set_xlim(min_x - (dx * 0.1), max_x + (dx * 0.1))
-        self.map_axis.set_ylim(min_y - (dy * 0.1), max_y + (dy * 0.1))
+        self.map_axis.set_xlim(*self.route_layer.xlim)
+        self.map_axis.set_ylim(*self.route_layer.ylim)
 
     def plot_marker(self) -> None:
         start = self.segment.coordinates[0]
@@ -220,18 +768,69 @@ class PanelRenderer(Renderer):
             marker.set_xdata([coordinate.longitude])
             marker.set_ydata([coordinate.latitude])
 
+    def plot_elevation(self) -> None:
+        self.elevation_axis = self.figure.add_axes(
+            [
+                0,
+                1 - self.map_height - self.elevation_height,
+                1,
+                self.elevation_height,
+            ]
+        )
+        self.elevation_axis.axis("off")
+
+        self.elevation_axis.imshow(
+            self.elevation_layer.image,
+            extent=self.elevation_layer.get_extent(),
+            interpolation="none",
+            aspect="auto",
+        )
+        self.elevation_axis.set_xlim(*self.elevation_layer.xlim)
+        self.elevation_axis.set_ylim(*self.elevation_layer.ylim)
+
+        distance = self.segment.coordinates[0].distance or 0.0
+        (self.elevation_cursor,) = self.elevation_axis.plot(
+            [distance],
+            [self.elevation_layer.get_altitude(distance)],
+            marker="o",
+            markerfacecolor="white",
+            markeredgecolor="white",
+            markersize=self.elevation_cursor_size,
+        )
+        self.grade_text = self.elevation_axis.text(
+            self.stats_x_position,
+            0.95,
+            self.grade_text_table.get_text("gradient", self.frame_offset) + "%",
+            color="white",
+            fontsize=self.elevation_font_size,
+            fontproperties=STATS_FONT,
+            verticalalignment="top",
+            transform=self.elevation_axis.transAxes,
+        )
+        self.grade_text.set_alpha(self.elevation_opacity)
+
+    def update_elevation(self, coordinate: GarminCoordinate, frame: int) -> None:
+        if coordinate.distance is not None:
+            self.elevation_cursor.set_xdata([coordinate.distance])
+            self.elevation_cursor.set_ydata(
+                [self.elevation_layer.get_altitude(coordinate.distance)]
+            )
+        if self.grade_text_table.changes["gradient"][frame]:
+            self.grade_text.set_text(
+                self.grade_text_table.get_text("gradient", frame) + "%"
+            )
+
     def plot_stats(self) -> None:
-        self.stats_axis = self.figure.add_axes([0, 0, 1, 1 - self.map_height])
+        self.stats_axis = self.figure.add_axes(
+            [0, 0, 1, 1 - self.map_height - self.elevation_height]
+        )
         self.stats_axis.axis("off")
         num_stats = len(self.stat_keys_and_labels)
         y_positions = list(np.linspace(*self.stats_y_range, num_stats))
         self.key_to_stat_map: Dict[str, Tuple[Any, Any]] = {}
-        start = self.segment.coordinates[0]
         for key_and_label, y_position in zip(self.stat_keys_and_labels, y_positions):
             key, label = key_and_label
-            value = start.__dict__[key]
-
-            value = self._make_value_text(value, label)
+            value = self.stat_text_table.get_text(key, self.frame_offset)
 
             stat_text = self.stats_axis.text(
                 self.stats_x_position,
@@ -254,90 +853,267 @@ class PanelRenderer(Renderer):
 
             self.key_to_stat_map[key] = (stat_text, label_text)
 
-    def update_stats(self, coordinate: GarminCoordinate) -> None:
-        for key, stat_and_label in self.key_to_stat_map.items():
-            stat, label = stat_and_label
-            value = self._make_value_text(coordinate.__dict__[key], label.get_text())
-            stat.set_text(value)
+    def update_stats(self, frame: int) -> None:
+        for key in self.stat_text_table.get_changed_keys(frame):
+            stat, _ = self.key_to_stat_map[key]
+            stat.set_text(self.stat_text_table.get_text(key, frame))
 
     def render(self) -> None:
         frame = 0
         for coordinate in self.subsegment.coordinates:
             self.update_marker(coordinate)
-            self.update_stats(coordinate)
-            self.figure.savefig(
-                f"{self.output_folder}/{self.thread_number:04}{frame:08}",
-                transparent=True,
-            )
+            if self.elevation_layer is not None:
+                self.update_elevation(coordinate, self.frame_offset + frame)
+            # the first frame's text is already set by plot_stats
+            if frame > 0:
+                self.update_stats(self.frame_offset + frame)
+            self.frame_store.write(self.frame_offset + frame, self.figure)
             frame += 1
-
-    @staticmethod
-    def _make_value_text(value: Any, label: str) -> str:
-        if value is None:
-            value = 0.0
-        elif type(value) is Speed:
-            if label.lower() == "mph":
-                value = value.get_miles_per_hour()
-            elif label.lower() == "mps":
-                value = value.get_meters_per_second()
-        return str(int(value))
+        self.frame_store.close()
 
 
 class VideoRenderer(Renderer):
+    """
+    Overlays rendered panels on the source video for one or more outputs.
+
+    The source chapters are decoded once and split in the filter graph, so
+    every output after the first only costs its own scaling and encoding.
+    Audio is stream copied through the concat demuxer when the chapters allow
+    it, re-encoded through the filter graph otherwise, or dropped entirely.
+    """
+
+    AUDIO_MODES = ["copy", "encode", "none"]
+    # in seconds, below the point where audio leading video becomes noticeable
+    AUDIO_SYNC_TOLERANCE = 0.045
+
     def __init__(
         self,
         video: GoProVideo,
         video_length: timedelta,
         video_offset: timedelta,
-        panel_folder: str,
-        output_filepath: str,
+        outputs: List[RenderOutput],
         num_threads: int,
+        audio: str = "copy",
+        fps: Optional[float] = None,
+        panel_format: Optional[Dict[str, Any]] = None,
     ) -> None:
+        assert audio in self.AUDIO_MODES
         self.video = video
         self.video_length = video_length
         self.video_offset = video_offset
-        self.panel_folder = panel_folder
-        self.output_filepath = output_filepath
+        self.outputs = outputs
         self.num_threads = num_threads
+        self.audio = audio
+        self.fps = fps if fps is not None else video.get_fps()
+        self.panel_format = panel_format
+        self.audio_list_path: Optional[str] = None
 
     def render(self) -> None:
-        video_inputs = []
-        audio_inputs = []
-        for video_path in self.video.video_paths:
-            input = ffmpeg.input(
-                video_path,
-            )
-            video_inputs.append(input.video)
-            audio_inputs.append(input.audio)
-
         start = self.video_offset.total_seconds()
         end = (self.video_length + self.video_offset).total_seconds()
 
-        video_input = ffmpeg.concat(*video_inputs).trim(
-            start=start,
-            end=end,
-        )
-        audio_input = ffmpeg.concat(*audio_inputs, v=0, a=1).filter(
-            "atrim", start=start, end=end
+        inputs = self.get_chapter_inputs(start, end)
+        video_inputs = [input.video for input in inputs]
+        audio_inputs = [input.audio for input in inputs]
+
+        video_input = (
+            ffmpeg.concat(*video_inputs)
+            .trim(
+                start=0,
+                end=end - start,
+            )
+            .setpts("PTS-STARTPTS")
         )
+        if self.fps != self.video.get_fps():
+            video_input = video_input.filter("fps", self.fps)
+        video_streams = self._split(video_input, "split")
 
-        panel_overlay = ffmpeg.input(
-            f"{self.panel_folder}/*.png",
-            pattern_type="glob",
-            framerate=self.video.get_fps(),
+        audio_mode = self.get_audio_mode(start, end)
+        audio_input, audio_options = self.get_audio_input(
+            audio_mode, start, end, audio_inputs
         )
+        if audio_mode == "encode":
+            audio_streams = self._split(audio_input, "asplit")
+        else:
+            audio_streams = [audio_input for _ in self.outputs]
 
-        video_input = video_input.overlay(panel_overlay)
-        audio_input = audio_input
+        print(f"Audio: {audio_mode}")
 
-        cmd = ffmpeg.output(
-            video_input,
-            audio_input,
-            self.output_filepath,
-            threads=self.num_threads,
-            preset="ultrafast",
-        )
+        cmds = []
+        for output, video_stream, audio_stream in zip(
+            self.outputs, video_streams, audio_streams
+        ):
+            video_stream = fit_to_resolution(
+                video_stream, self.video.get_resolution(), output
+            )
+
+            panel_overlay = PanelFrameStore.from_config(
+                output.panel_folder,
+                get_panel_size(output.resolution, output.panel_config["panelWidth"]),
+                self.panel_format,
+            ).get_input(self.fps)
+
+            streams = [video_stream.overlay(panel_overlay)]
+            if audio_stream is not None:
+                streams.append(audio_stream)
+
+            cmds.append(
+                ffmpeg.output(
+                    *streams,
+                    output.filepath,
+                    threads=self.num_threads,
+                    **audio_options,
+                    **output.encoder_options,
+                )
+            )
+
+        cmd = ffmpeg.merge_outputs(*cmds)
 
         print(f"\nRunning command: ffmpeg {' '.join(cmd.get_args())}\n\n")
 
+        try:
+            cmd.run(overwrite_output=True)
+        finally:
+            self.remove_audio_list()
+
+    def get_audio_mode(self, start: float, end: float) -> str:
+        if self.audio != "copy":
+            return self.audio
+
+        audio_formats = self.video.get_audio_formats()
+        if len(audio_formats) == 0:
+            return "none"
+        # the concat demuxer can only join chapters with identical audio streams
+        if len(audio_formats) > 1 or None in audio_formats:
+            return "encode"
+
+        needs_trim = start > 0 or end < self.video.get_duration().total_seconds()
+        if not needs_trim:
+            return "copy"
+        # a copied stream can only be cut on packet boundaries, which is
+        # accurate enough as long as the error stays below noticeable lip sync
+        packet_duration = self.video.get_audio_packet_duration()
+        if packet_duration is None or packet_duration > self.AUDIO_SYNC_TOLERANCE:
+            return "encode"
+
+        return "copy"
+
+    def get_chapter_inputs(self, start: float, end: float) -> List[Any]:
+        """
+        Inputs for the chapters overlapping start..end, with the first one seeked
+        to start, so no frames before the rendered window are decoded.
+        """
+        inputs = []
+        for video_path, chapter_start, chapter_end in self.video.get_chapters():
+            if chapter_end <= start or chapter_start >= end:
+                continue
+            if len(inputs) == 0 and start > chapter_start:
+                inputs.append(ffmpeg.input(video_path, ss=start - chapter_start))
+            else:
+                inputs.append(ffmpeg.input(video_path))
+        return inputs
+
+    def get_audio_input(
+        self, audio_mode: str, start: float, end: float, audio_inputs: List[Any]
+    ) -> Tuple[Any, Dict[str, Any]]:
+        """
+        The trimmed audio stream for an audio mode and its output options.
+        The audio inputs are expected to come from get_chapter_inputs.
+        """
+        if audio_mode == "copy":
+            self.audio_list_path = self.write_audio_list(start, end)
+            audio_input = ffmpeg.input(self.audio_list_path, f="concat", safe=0).audio
+            return audio_input, {"acodec": "copy"}
+        elif audio_mode == "encode":
+            audio_input = (
+                ffmpeg.concat(*audio_inputs, v=0, a=1)
+                .filter("atrim", start=0, end=end - start)
+                .filter("asetpts", "PTS-STARTPTS")
+            )
+            return audio_input, {}
+        return None, {}
+
+    def remove_audio_list(self) -> None:
+        if self.audio_list_path is not None:
+            os.remove(self.audio_list_path)
+            self.audio_list_path = None
+
+    def write_audio_list(self, start: float, end: float) -> str:
+        files = []
+        for video_path, chapter_start, chapter_end in self.video.get_chapters():
+            if chapter_end > start and chapter_start < end:
+                files.append(
+                    (
+                        video_path,
+                        start - chapter_start if start > chapter_start else None,
+                        end - chapter_start if end < chapter_end else None,
+                    )
+                )
+        return write_concat_list(files)
+
+    def _split(self, stream, split_filter: str) -> List[Any]:
+        if len(self.outputs) == 1:
+            return [stream]
+        split = stream.filter_multi_output(split_filter, len(self.outputs))
+        return [split.stream(index) for index in range(len(self.outputs))]
+
+
+def fit_to_resolution(
+    stream, source_resolution: Tuple[int, int], output: RenderOutput
+):
+    """Scale or crop a video stream to the resolution of an output."""
+    if output.resolution == source_resolution:
+        return stream
+
+    width, height = output.resolution
+    if output.fit == "crop":
+        return stream.filter(
+            "scale", width, height, force_original_aspect_ratio="increase"
+        ).filter("crop", width, height)
+    return stream.filter("scale", width, height)
+
+
+def write_concat_list(
+    files: List[Tuple[str, Optional[float], Optional[float]]],
+    filepath: Optional[str] = None,
+) -> str:
+    """
+    Write an ffconcat list of (path, inpoint, outpoint) entries, where the in
+    and out points in seconds are optional, and return its path. Without a
+    filepath, the list is written to a temporary file the caller removes.
+    """
+    lines = ["ffconcat version 1.0"]
+    for path, inpoint, outpoint in files:
+        escaped_path = os.path.abspath(path).replace("'", "'\\''")
+        lines.append(f"file '{escaped_path}'")
+        if inpoint is not None:
+            lines.append(f"inpoint {inpoint:.6f}")
+        if outpoint is not None:
+            lines.append(f"outpoint {outpoint:.6f}")
+
+    if filepath is None:
+        concat_list_file = tempfile.NamedTemporaryFile(
+            "w", suffix=".ffconcat", delete=False
+        )
+    else:
+        concat_list_file = open(filepath, "w")
+    with concat_list_file:
+        concat_list_file.write("\n".join(lines) + "\n")
+    return concat_list_file.name
+
+
+def concat_videos(filepaths: List[str], output_filepath: str) -> None:
+    """Join videos encoded with the same settings without re-encoding them."""
+    concat_list_path = write_concat_list(
+        [(filepath, None, None) for filepath in filepaths]
+    )
+
+    cmd = ffmpeg.input(concat_list_path, f="concat", safe=0).output(
+        output_filepath, c="copy"
+    )
+    print(f"\nRunning command: ffmpeg {' '.join(cmd.get_args())}\n\n")
+
+    try:
         cmd.run(overwrite_output=True)
+    finally:
+        os.remove(concat_list_path)
@@ -0,0 +1,165 @@
+"""
+Sizing of the panel worker pool and encoder threads for the machine a render
+runs on, used when the render config sets panelNumberOfThreads or
+videoNumberOfThreads to "auto".
+"""
+
+import os
+import pickle
+from typing import Any, Dict, List, Optional, Tuple
+
+AUTO = "auto"
+# leave some memory for ffmpeg and the rest of the system
+MEMORY_BUDGET_FRACTION = 0.8
+# unpickled coordinates take up several times their pickled size
+SEGMENT_MEMORY_FACTOR = 3
+
+
+class ResourcePlan:
+    def __init__(
+        self,
+        panel_threads: int,
+        video_threads: int,
+        cores: int,
+        available_memory: Optional[int],
+        base_memory: int,
+        worker_memory: int,
+    ) -> None:
+        self.panel_threads = panel_threads
+        self.video_threads = video_threads
+        self.cores = cores
+        self.available_memory = available_memory
+        self.base_memory = base_memory
+        self.worker_memory = worker_memory
+
+    def __str__(self) -> str:
+        available_memory = (
+            "unknown"
+            if self.available_memory is None
+            else f"{self.available_memory / 2**30:.1f} GiB"
+        )
+        return (
+            f"{self.panel_threads} panel threads and {self.video_threads} video threads "
+            f"({self.cores} cores, {available_memory} available, "
+            f"{self.base_memory / 2**20:.0f} MiB shared and "
+            f"{self.worker_memory / 2**20:.0f} MiB per panel worker)"
+        )
+
+
+def get_num_cores() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def get_available_memory() -> Optional[int]:
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def _get_resident_memory() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def measure_panel_memory(resolution: Tuple[int, int], panel_width: float) -> int:
+    """Memory taken by drawing and saving one panel figure at this size."""
+    import io
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from render import get_panel_figsize
+
+    before = _get_resident_memory()
+    figure = Figure(
+        frameon=False, dpi=100, figsize=get_panel_figsize(resolution, panel_width)
+    )
+    canvas = FigureCanvasAgg(figure)
+    figure.add_axes([0, 0, 1, 1]).axis("off")
+    figure.savefig(io.BytesIO(), transparent=True)
+    after = _get_resident_memory()
+
+    width, height = canvas.get_width_height()
+    # the canvas, a copy for saving and the encoded frame
+    estimate = width * height * 4 * 3
+    if before is None or after is None:
+        return estimate
+    return max(after - before, estimate)
+
+
+def estimate_segment_memory(coordinates: List[Any], num_frames: int) -> int:
+    sample = coordinates[:100]
+    if len(sample) == 0:
+        return 0
+    bytes_per_coordinate = len(pickle.dumps(sample)) / len(sample)
+    return int(bytes_per_coordinate * num_frames * SEGMENT_MEMORY_FACTOR)
+
+
+def plan_resources(
+    panel_sizes: List[Tuple[Tuple[int, int], float]],
+    coordinates: List[Any],
+    num_frames: int,
+) -> ResourcePlan:
+    """
+    Size the panel pool by cores and by how many workers fit in memory, where
+    every worker holds a figure at the largest panel size and a copy of the
+    resampled segment on top of the memory it shares with this process when
+    forked. Encoder threads get every core, as panels are rendered first.
+    """
+    cores = get_num_cores()
+    available_memory = get_available_memory()
+
+    # counted once, as forked workers share its pages until they write to them
+    base_memory = _get_resident_memory() or 0
+    panel_memory = max(
+        measure_panel_memory(resolution, panel_width)
+        for resolution, panel_width in panel_sizes
+    )
+    worker_memory = panel_memory + estimate_segment_memory(coordinates, num_frames)
+
+    panel_threads = cores
+    if available_memory is not None and worker_memory > 0:
+        memory_budget = available_memory * MEMORY_BUDGET_FRACTION - base_memory
+        panel_threads = min(panel_threads, int(memory_budget // worker_memory))
+    panel_threads = max(1, min(panel_threads, num_frames))
+
+    return ResourcePlan(
+        panel_threads=panel_threads,
+        video_threads=cores,
+        cores=cores,
+        available_memory=available_memory,
+        base_memory=base_memory,
+        worker_memory=worker_memory,
+    )
+
+
+def resolve_thread_counts(
+    render_config: Dict[str, Any],
+    panel_sizes: List[Tuple[Tuple[int, int], float]],
+    coordinates: List[Any],
+    num_frames: int,
+) -> Tuple[int, int]:
+    """Thread counts from the render config, planning any that are set to auto."""
+    panel_threads = render_config["panelNumberOfThreads"]
+    video_threads = render_config["videoNumberOfThreads"]
+
+    if AUTO in [panel_threads, video_threads]:
+        plan = plan_resources(panel_sizes, coordinates, num_frames)
+        print(f"Resource plan: {plan}")
+        if panel_threads == AUTO:
+            panel_threads = plan.panel_threads
+        if video_threads == AUTO:
+            video_threads = plan.video_threads
+
+    return panel_threads, video_threads
@@ -0,0 +1,207 @@
+"""
+Long running render service for localhost.
+
+Starting a render from the command line pays for process startup, imports,
+font loading and starting every panel worker before the first frame is drawn.
+The service does that once and keeps a warm pool of panel workers, along with
+the probed videos and decoded FIT files, for every job it runs. The workers
+keep their imports and fonts between jobs, but each task still builds its own
+panel figure, as the map and stats differ from job to job.
+
+    python service.py --port 8765 --panel-threads 48
+
+Jobs are JSON objects with the same options as the render subcommand of
+main.py, using the argument names with underscores, e.g. "fit_file",
+"video_files", "video_output_path", "video_lap_time_in_secs",
+"lap_time_search_window_in_secs" and "render_config_file" (or an inline
+"render_config"). Jobs run one at a time in the order they are submitted.
+
+    POST /jobs        submit a job, returns its id
+    GET  /jobs        status of every job
+    GET  /jobs/<id>   status, progress and metrics of a job
+
+Finished jobs are forgotten after a day, or once more than 1000 of them have
+finished, starting with the oldest.
+"""
+
+import argparse
+import json
+import queue
+import threading
+import time
+import traceback
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import pool
+from typing import Any, Dict, Optional
+
+import pipeline
+
+# imported up front so forked panel workers start with matplotlib and the
+# stats font already loaded
+import render  # noqa: F401
+
+# finished jobs are only kept around for their status and metrics
+FINISHED_JOB_TTL_IN_SECS = 24 * 3600
+MAX_FINISHED_JOBS = 1000
+
+
+class Job:
+    def __init__(self, options: Dict[str, Any]) -> None:
+        self.id = uuid.uuid4().hex
+        self.options = options
+        self.status = "queued"
+        self.stage: Optional[str] = None
+        self.progress = 0.0
+        self.metrics: Dict[str, float] = {}
+        self.error: Optional[str] = None
+        self.submitted_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": self.progress,
+            "metrics": self.metrics,
+            "error": self.error,
+            "submittedAt": self.submitted_at,
+            "startedAt": self.started_at,
+            "finishedAt": self.finished_at,
+        }
+
+
+class RenderService:
+    def __init__(self, panel_threads: int) -> None:
+        self.worker_pool = pool.Pool(panel_threads)
+        self.jobs: Dict[str, Job] = {}
+        self.queue: "queue.Queue[Job]" = queue.Queue()
+        self.lock = threading.Lock()
+        self.runner = threading.Thread(target=self._run_jobs, daemon=True)
+        self.runner.start()
+
+    def submit(self, options: Dict[str, Any]) -> Job:
+        job = Job(options)
+        with self.lock:
+            self._evict_finished_jobs()
+            self.jobs[job.id] = job
+        self.queue.put(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return None if job is None else job.to_dict()
+
+    def list(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"jobs": [job.to_dict() for job in self.jobs.values()]}
+
+    def _evict_finished_jobs(self) -> None:
+        # called with the lock held
+        now = time.time()
+        finished_jobs = sorted(
+            (job for job in self.jobs.values() if job.finished_at is not None),
+            key=lambda job: job.finished_at,
+        )
+        for index, job in enumerate(finished_jobs):
+            if (
+                now - job.finished_at > FINISHED_JOB_TTL_IN_SECS
+                or len(finished_jobs) - index > MAX_FINISHED_JOBS
+            ):
+                del self.jobs[job.id]
+
+    def _update(self, job: Job, **fields: Any) -> None:
+        with self.lock:
+            for key, value in fields.items():
+                setattr(job, key, value)
+
+    def _run_jobs(self) -> None:
+        while True:
+            job = self.queue.get()
+            self._update(job, status="running", stage="align", started_at=time.time())
+            try:
+                align_start_time = time.time()
+                prepared = pipeline.prepare(pipeline.RenderJob.from_args(job.options))
+                align_seconds = time.time() - align_start_time
+
+                metrics = pipeline.render(
+                    prepared,
+                    worker_pool=self.worker_pool,
+                    progress=lambda stage, fraction: self._update(
+                        job, stage=stage, progress=fraction
+                    ),
+                )
+                self._update(
+                    job,
+                    status="done",
+                    progress=1.0,
+                    metrics={"alignSecs": align_seconds, **metrics},
+                )
+            except Exception as exception:
+                traceback.print_exc()
+                self._update(job, status="failed", error=repr(exception))
+            finally:
+                self._update(job, finished_at=time.time())
+
+
+def make_handler(service: RenderService):
+    class RenderServiceHandler(BaseHTTPRequestHandler):
+        def _send(self, status: int, body: Dict[str, Any]) -> None:
+            data = json.dumps(body, default=str).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self) -> None:
+            parts = self.path.strip("/").split("/")
+            if parts == ["jobs"]:
+                self._send(200, service.list())
+            elif len(parts) == 2 and parts[0] == "jobs":
+                job = service.get(parts[1])
+                if job is None:
+                    self._send(404, {"error": "Unknown job"})
+                else:
+                    self._send(200, job)
+            else:
+                self._send(404, {"error": "Unknown path"})
+
+        def do_POST(self) -> None:
+            if self.path.strip("/") != "jobs":
+                self._send(404, {"error": "Unknown path"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                options = json.loads(self.rfile.read(length))
+            except ValueError as exception:
+                self._send(400, {"error": repr(exception)})
+                return
+            self._send(202, service.submit(options).to_dict())
+
+    return RenderServiceHandler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Long running render service with a warm pool of panel workers"
+    )
+    parser.add_argument(
+        "--host", help="Address to listen on", type=str, default="127.0.0.1"
+    )
+    parser.add_argument("--port", help="Port to listen on", type=int, default=8765)
+    parser.add_argument(
+        "--panel-threads",
+        help="Number of panel worker processes to keep running",
+        type=int,
+        required=True,
+    )
+    args = vars(parser.parse_args())
+
+    service = RenderService(args["panel_threads"])
+    server = ThreadingHTTPServer((args["host"], args["port"]), make_handler(service))
+    print(f"Render service listening on http://{args['host']}:{args['port']}")
+    server.serve_forever()
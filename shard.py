@@ -0,0 +1,368 @@
+"""
+Sharded rendering for running one video across several machines.
+
+main.py --shards N acts as the coordinator: it aligns the video with the FIT
+file and writes a manifest, plus a cache of the decoded FIT file, into a work
+directory on shared storage. Each shard is then rendered and encoded by an
+independent worker, and the finished shards are concatenated by stream copy:
+
+    python shard.py work shards/manifest.json --shard 3
+    python shard.py status shards/manifest.json
+    python shard.py merge shards/manifest.json
+
+A shard is only considered done once its encoded files have been moved into
+place, so failed shards can be re-run on their own with work --shard.
+For local testing, python shard.py local shards/manifest.json --workers 4
+runs every pending shard in separate worker processes and merges the result.
+"""
+
+import argparse
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from multiprocessing import pool
+from typing import Any, Dict, List, Optional
+
+import ffmpeg
+
+from config import get_render_outputs, assign_panel_folders, get_panel_renderer_options
+from coordinate import GarminSegment
+from resources import resolve_thread_counts, get_num_cores
+from video import GoProVideo
+
+
+MANIFEST_FILENAME = "manifest.json"
+FIT_CACHE_FILENAME = "segment.pickle"
+
+
+def write_manifest(
+    work_dir: str,
+    num_shards: int,
+    video: GoProVideo,
+    garmin_segment: GarminSegment,
+    garmin_start_time: datetime,
+    video_offset: timedelta,
+    video_length: timedelta,
+    video_output_path: str,
+    render_config: Dict[str, Any],
+) -> str:
+    os.makedirs(work_dir, exist_ok=True)
+
+    fit_cache_path = os.path.join(work_dir, FIT_CACHE_FILENAME)
+    with open(fit_cache_path, "wb") as fit_cache_file:
+        pickle.dump(garmin_segment, fit_cache_file)
+
+    # shard boundaries fall on frame boundaries so no frame is rendered twice
+    fps = video.get_fps()
+    num_frames = int(video_length.total_seconds() * fps)
+    frame_boundaries = [
+        round(shard * num_frames / num_shards) for shard in range(num_shards + 1)
+    ]
+
+    shards = []
+    for index, (start_frame, end_frame) in enumerate(
+        zip(frame_boundaries[:-1], frame_boundaries[1:])
+    ):
+        shards.append(
+            {
+                "index": index,
+                "offsetInSecs": start_frame / fps,
+                "lengthInSecs": (end_frame - start_frame) / fps,
+            }
+        )
+
+    manifest = {
+        "videoFiles": [os.path.abspath(path) for path in video.video_paths],
+        "fitCache": os.path.abspath(fit_cache_path),
+        "garminStartTime": garmin_start_time.isoformat(),
+        "videoOffsetInSecs": video_offset.total_seconds(),
+        "videoLengthInSecs": video_length.total_seconds(),
+        "videoOutputPath": os.path.abspath(video_output_path),
+        "workDir": os.path.abspath(work_dir),
+        "renderConfig": render_config,
+        "shards": shards,
+    }
+
+    manifest_path = os.path.join(work_dir, MANIFEST_FILENAME)
+    with open(manifest_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+
+    return manifest_path
+
+
+def load_manifest(manifest_path: str) -> Dict[str, Any]:
+    with open(manifest_path) as manifest_file:
+        return json.loads(manifest_file.read())
+
+
+def get_shard_path(manifest: Dict[str, Any], index: int) -> str:
+    return os.path.join(manifest["workDir"], f"shard-{index:04}.mp4")
+
+
+def get_shard_filepaths(manifest: Dict[str, Any], index: int) -> List[str]:
+    video = GoProVideo(manifest["videoFiles"])
+    outputs = get_render_outputs(
+        manifest["renderConfig"],
+        get_shard_path(manifest, index),
+        video.get_resolution(),
+    )
+    return [output.filepath for output in outputs]
+
+
+def get_pending_shards(manifest: Dict[str, Any]) -> List[int]:
+    return [
+        shard["index"]
+        for shard in manifest["shards"]
+        if not all(
+            os.path.exists(path) for path in get_shard_filepaths(manifest, shard["index"])
+        )
+    ]
+
+
+def render_shard(
+    manifest: Dict[str, Any], index: int, num_threads: Optional[int] = None
+) -> None:
+    from render import ThreadedPanelRenderer, VideoRenderer
+
+    shard = manifest["shards"][index]
+    render_config = manifest["renderConfig"]
+    video = GoProVideo(manifest["videoFiles"])
+
+    with open(manifest["fitCache"], "rb") as fit_cache_file:
+        garmin_segment: GarminSegment = pickle.load(fit_cache_file)
+
+    garmin_start_time = datetime.fromisoformat(manifest["garminStartTime"])
+    shard_offset = timedelta(seconds=shard["offsetInSecs"])
+    shard_length = timedelta(seconds=shard["lengthInSecs"])
+
+    shard_path = get_shard_path(manifest, index)
+    partial_path = os.path.join(manifest["workDir"], f"shard-{index:04}.partial.mp4")
+    outputs = get_render_outputs(render_config, partial_path, video.get_resolution())
+    filepaths = get_shard_filepaths(manifest, index)
+    panel_folder = os.path.join(manifest["workDir"], f"panel-{index:04}")
+    panels_to_render = assign_panel_folders(outputs, panel_folder)
+
+    if num_threads is not None:
+        panel_threads, video_threads = num_threads, num_threads
+    else:
+        panel_threads, video_threads = resolve_thread_counts(
+            render_config,
+            [
+                (output.resolution, output.panel_config["panelWidth"])
+                for output in panels_to_render
+            ],
+            garmin_segment.coordinates,
+            int(shard_length.total_seconds() * video.get_fps()),
+        )
+
+    for output in panels_to_render:
+        ThreadedPanelRenderer(
+            segment=garmin_segment,
+            segment_start_time=garmin_start_time + shard_offset,
+            video_length=shard_length,
+            video=video,
+            output_folder=output.panel_folder,
+            num_threads=panel_threads,
+            resolution=output.resolution,
+            route_start_time=garmin_start_time,
+            route_length=timedelta(seconds=manifest["videoLengthInSecs"]),
+            panel_format=render_config.get("panelFormat"),
+            rider_weight=render_config.get("riderWeight"),
+            **get_panel_renderer_options(output.panel_config),
+        ).render()
+
+    # audio is muxed once for the whole video in the merge step, so shard
+    # boundaries never cut through an audio packet
+    VideoRenderer(
+        video=video,
+        outputs=outputs,
+        num_threads=video_threads,
+        video_length=shard_length,
+        video_offset=timedelta(seconds=manifest["videoOffsetInSecs"]) + shard_offset,
+        audio="none",
+        panel_format=render_config.get("panelFormat"),
+    ).render()
+
+    for output, filepath in zip(outputs, filepaths):
+        os.replace(output.filepath, filepath)
+    for output in panels_to_render:
+        shutil.rmtree(output.panel_folder)
+
+    print(f"Finished shard {index} ({shard_path}).")
+
+
+def merge_shards(manifest: Dict[str, Any]) -> None:
+    from render import VideoRenderer, write_concat_list
+
+    pending_shards = get_pending_shards(manifest)
+    assert len(pending_shards) == 0, f"Shards not rendered yet: {pending_shards}"
+
+    render_config = manifest["renderConfig"]
+    video = GoProVideo(manifest["videoFiles"])
+    outputs = get_render_outputs(
+        render_config, manifest["videoOutputPath"], video.get_resolution()
+    )
+
+    audio_renderer = VideoRenderer(
+        video=video,
+        outputs=outputs,
+        num_threads=get_num_cores(),
+        video_length=timedelta(seconds=manifest["videoLengthInSecs"]),
+        video_offset=timedelta(seconds=manifest["videoOffsetInSecs"]),
+        audio=render_config.get("audio", "copy"),
+    )
+    start = manifest["videoOffsetInSecs"]
+    end = start + manifest["videoLengthInSecs"]
+    audio_mode = audio_renderer.get_audio_mode(start, end)
+
+    for output_index, output in enumerate(outputs):
+        shard_filepaths = [
+            get_shard_filepaths(manifest, shard["index"])[output_index]
+            for shard in manifest["shards"]
+        ]
+        shard_list_path = write_concat_list(
+            [(shard_filepath, None, None) for shard_filepath in shard_filepaths],
+            os.path.join(manifest["workDir"], f"shards-{output_index}.ffconcat"),
+        )
+
+        audio_input, audio_options = audio_renderer.get_audio_input(
+            audio_mode,
+            start,
+            end,
+            [input.audio for input in audio_renderer.get_chapter_inputs(start, end)],
+        )
+        streams = [ffmpeg.input(shard_list_path, f="concat", safe=0).video]
+        if audio_input is not None:
+            streams.append(audio_input)
+
+        cmd = ffmpeg.output(*streams, output.filepath, vcodec="copy", **audio_options)
+
+        print(f"\nRunning command: ffmpeg {' '.join(cmd.get_args())}\n\n")
+
+        try:
+            cmd.run(overwrite_output=True)
+        finally:
+            audio_renderer.remove_audio_list()
+
+
+def _run_worker(args) -> int:
+    manifest_path, index, num_threads, retries = args
+    command = [sys.executable, os.path.abspath(__file__), "work", manifest_path]
+    command += ["--shard", str(index)]
+    if num_threads is not None:
+        command += ["--threads", str(num_threads)]
+
+    for attempt in range(retries + 1):
+        if subprocess.run(command).returncode == 0:
+            return index
+        print(f"Shard {index} failed (attempt {attempt + 1} of {retries + 1}).")
+
+    return -1
+
+
+def render_locally(
+    manifest_path: str,
+    num_workers: int,
+    num_threads: Optional[int],
+    retries: int,
+) -> bool:
+    """Render every pending shard with worker processes standing in for nodes."""
+    manifest = load_manifest(manifest_path)
+    pending_shards = get_pending_shards(manifest)
+    print(f"Rendering shards {pending_shards} with {num_workers} workers.")
+
+    if num_threads is None and "auto" in [
+        manifest["renderConfig"]["panelNumberOfThreads"],
+        manifest["renderConfig"]["videoNumberOfThreads"],
+    ]:
+        # the workers share this machine, so don't let each one plan for all of it
+        num_threads = max(1, get_num_cores() // num_workers)
+
+    results = pool.ThreadPool(num_workers).map(
+        _run_worker,
+        [(manifest_path, index, num_threads, retries) for index in pending_shards],
+    )
+
+    failed_shards = [index for index, result in zip(pending_shards, results) if result < 0]
+    if len(failed_shards) > 0:
+        print(f"Failed shards: {failed_shards}. Re-run them with work --shard.")
+        return False
+
+    merge_shards(manifest)
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Render a video written by main.py --shards as independent shards"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    work_parser = subparsers.add_parser("work", help="Render and encode shards")
+    work_parser.add_argument("manifest", help="Path to the shard manifest", type=str)
+    work_parser.add_argument(
+        "--shard",
+        help="Index of the shard to render. Renders every pending shard if omitted",
+        type=int,
+        default=None,
+    )
+    work_parser.add_argument(
+        "--threads",
+        help="Override the number of panel and video threads from the render config",
+        type=int,
+        default=None,
+    )
+
+    status_parser = subparsers.add_parser("status", help="List pending shards")
+    status_parser.add_argument("manifest", help="Path to the shard manifest", type=str)
+
+    merge_parser = subparsers.add_parser(
+        "merge", help="Concatenate rendered shards into the output video"
+    )
+    merge_parser.add_argument("manifest", help="Path to the shard manifest", type=str)
+
+    local_parser = subparsers.add_parser(
+        "local", help="Render all pending shards with local worker processes and merge"
+    )
+    local_parser.add_argument("manifest", help="Path to the shard manifest", type=str)
+    local_parser.add_argument(
+        "--workers", help="Number of worker processes", type=int, default=2
+    )
+    local_parser.add_argument(
+        "--threads",
+        help="Override the number of panel and video threads for each worker",
+        type=int,
+        default=None,
+    )
+    local_parser.add_argument(
+        "--retries", help="How many times to retry a failed shard", type=int, default=1
+    )
+
+    args = vars(parser.parse_args())
+    manifest = load_manifest(args["manifest"])
+    start_time = time.time()
+
+    if args["command"] == "work":
+        shards = (
+            [args["shard"]] if args["shard"] is not None else get_pending_shards(manifest)
+        )
+        for index in shards:
+            render_shard(manifest, index, args["threads"])
+    elif args["command"] == "status":
+        pending_shards = get_pending_shards(manifest)
+        print(f"{len(manifest['shards']) - len(pending_shards)} of {len(manifest['shards'])} shards rendered.")
+        print(f"Pending shards: {pending_shards}")
+    elif args["command"] == "merge":
+        merge_shards(manifest)
+    elif args["command"] == "local":
+        if not render_locally(
+            args["manifest"], args["workers"], args["threads"], args["retries"]
+        ):
+            sys.exit(1)
+
+    print(f"\nTotal time: {time.time() - start_time} seconds.")
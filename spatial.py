@@ -0,0 +1,300 @@
+"""
+Spatial lookups over the positions of a ride, used to find known route
+segments, such as a named climb, and to detect climbs from the altitude series.
+
+Positions are projected once to meters around the ride and bucketed into a
+uniform grid, so finding the ride points near a position only looks at the
+cells around it instead of the whole ride.
+"""
+
+import json
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+import numpy as np
+
+from coordinate import GarminSegment, get_monotonic_distances
+
+EARTH_RADIUS = 6371008.8
+# cell columns are spaced this far apart in the combined cell key
+CELL_KEY_STRIDE = 2**32
+
+
+def project(
+    latitudes: np.ndarray, longitudes: np.ndarray, origin_latitude: float
+) -> np.ndarray:
+    """Equirectangular projection to meters, accurate over the area of a ride."""
+    return np.column_stack(
+        (
+            np.radians(longitudes) * EARTH_RADIUS * np.cos(np.radians(origin_latitude)),
+            np.radians(latitudes) * EARTH_RADIUS,
+        )
+    )
+
+
+def get_cumulative_distances(points: np.ndarray) -> np.ndarray:
+    steps = np.hypot(*np.diff(points, axis=0).T)
+    return np.concatenate(([0.0], np.cumsum(steps)))
+
+
+class SpatialIndex:
+    def __init__(
+        self, latitudes: np.ndarray, longitudes: np.ndarray, cell_size: float = 50.0
+    ) -> None:
+        self.origin_latitude = float(np.mean(latitudes)) if len(latitudes) > 0 else 0.0
+        self.cell_size = cell_size
+        self.points = project(latitudes, longitudes, self.origin_latitude)
+        self.distances = get_cumulative_distances(self.points)
+
+        # points sorted by cell, and by their position in the ride within a cell
+        keys = self._get_cell_keys(np.floor(self.points / cell_size).astype(np.int64))
+        self.order = np.argsort(keys, kind="stable")
+        self.sorted_keys = keys[self.order]
+
+    @staticmethod
+    def from_segment(segment: GarminSegment, cell_size: float = 50.0) -> "SpatialIndex":
+        return SpatialIndex(
+            np.array([coordinate.latitude for coordinate in segment.coordinates]),
+            np.array([coordinate.longitude for coordinate in segment.coordinates]),
+            cell_size,
+        )
+
+    @staticmethod
+    def _get_cell_keys(cells: np.ndarray) -> np.ndarray:
+        return cells[..., 0] * CELL_KEY_STRIDE + cells[..., 1]
+
+    def project(self, latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+        return project(latitudes, longitudes, self.origin_latitude)
+
+    def query(self, point: np.ndarray, radius: float) -> np.ndarray:
+        """Indices, in ride order, of the points within radius of a projected point."""
+        low = np.floor((point - radius) / self.cell_size).astype(np.int64)
+        high = np.floor((point + radius) / self.cell_size).astype(np.int64)
+
+        # the cells of one column are next to each other in key order
+        candidates = []
+        for column in range(low[0], high[0] + 1):
+            start = np.searchsorted(
+                self.sorted_keys, column * CELL_KEY_STRIDE + low[1], side="left"
+            )
+            end = np.searchsorted(
+                self.sorted_keys, column * CELL_KEY_STRIDE + high[1], side="right"
+            )
+            candidates.append(self.order[start:end])
+        candidates = np.concatenate(candidates)
+
+        offsets = self.points[candidates] - point
+        return np.sort(candidates[np.hypot(offsets[:, 0], offsets[:, 1]) <= radius])
+
+    def get_passes(self, point: np.ndarray, radius: float) -> np.ndarray:
+        """
+        The closest point of every pass through radius of a projected point,
+        a pass being a run of consecutive ride points inside the radius.
+        """
+        indices = self.query(point, radius)
+        if len(indices) == 0:
+            return indices
+
+        offsets = self.points[indices] - point
+        distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        passes = np.split(
+            np.arange(len(indices)), np.flatnonzero(np.diff(indices) > 1) + 1
+        )
+        return np.array(
+            [
+                indices[ride_pass[np.argmin(distances[ride_pass])]]
+                for ride_pass in passes
+            ]
+        )
+
+
+class ReferenceSegment:
+    def __init__(
+        self, name: str, latitudes: np.ndarray, longitudes: np.ndarray
+    ) -> None:
+        assert len(latitudes) >= 2, f"Segment {name} needs at least two points"
+        self.name = name
+        self.latitudes = latitudes
+        self.longitudes = longitudes
+
+    @staticmethod
+    def from_dict(segment_config: Dict[str, Any]) -> "ReferenceSegment":
+        points = np.array(segment_config["points"], dtype=float)
+        return ReferenceSegment(segment_config["name"], points[:, 0], points[:, 1])
+
+
+def load_reference_segments(path: str) -> List[ReferenceSegment]:
+    """
+    Reference segments from a JSON file of the form
+    {"segments": [{"name": "Hawk Hill", "points": [[lat, long], ...]}, ...]}.
+    """
+    with open(path) as segments_file:
+        return [
+            ReferenceSegment.from_dict(segment_config)
+            for segment_config in json.loads(segments_file.read())["segments"]
+        ]
+
+
+class SegmentMatch:
+    def __init__(
+        self, name: str, start_index: int, end_index: int, segment: GarminSegment
+    ) -> None:
+        self.name = name
+        self.start_index = start_index
+        self.end_index = end_index
+        self.start_time: datetime = segment.coordinates[start_index].timestamp
+        self.end_time: datetime = segment.coordinates[end_index].timestamp
+
+    def get_elapsed_time(self) -> timedelta:
+        return self.end_time - self.start_time
+
+
+def match_segments(
+    segment: GarminSegment,
+    references: List[ReferenceSegment],
+    radius: float = 25.0,
+    num_checkpoints: int = 10,
+    length_tolerance: float = 0.2,
+) -> List[SegmentMatch]:
+    """
+    Every time the ride covers a reference segment, in order of time. A match
+    starts and ends at the ride points closest to the ends of the reference,
+    is about as long as the reference, and passes within radius (in meters) of
+    checkpoints spread along the reference in between.
+    """
+    index = segment.get_spatial_index()
+
+    matches = []
+    for reference in references:
+        points = index.project(reference.latitudes, reference.longitudes)
+        distances = get_cumulative_distances(points)
+        length = distances[-1]
+        checkpoints = np.column_stack(
+            [
+                np.interp(
+                    np.linspace(0, length, num_checkpoints + 2)[1:-1],
+                    distances,
+                    points[:, axis],
+                )
+                for axis in range(2)
+            ]
+        )
+        checkpoint_indices = [
+            index.query(checkpoint, radius) for checkpoint in checkpoints
+        ]
+
+        starts = index.get_passes(points[0], radius)
+        ends = index.get_passes(points[-1], radius)
+
+        previous_end = -1
+        for start in starts:
+            if start <= previous_end:
+                continue
+            position = np.searchsorted(ends, start, side="right")
+            if position == len(ends):
+                break
+            end = ends[position]
+
+            ride_length = index.distances[end] - index.distances[start]
+            if abs(ride_length - length) > length * length_tolerance + 2 * radius:
+                continue
+            if not all(
+                np.any((indices >= start) & (indices <= end))
+                for indices in checkpoint_indices
+            ):
+                continue
+
+            matches.append(SegmentMatch(reference.name, int(start), int(end), segment))
+            previous_end = end
+
+    return sorted(matches, key=lambda match: match.start_time)
+
+
+class Climb:
+    def __init__(
+        self,
+        start_index: int,
+        end_index: int,
+        distance: float,
+        gain: float,
+        segment: GarminSegment,
+    ) -> None:
+        self.start_index = start_index
+        self.end_index = end_index
+        self.distance = distance
+        self.gain = gain
+        self.average_grade = gain / distance * 100
+        self.start_time: datetime = segment.coordinates[start_index].timestamp
+        self.end_time: datetime = segment.coordinates[end_index].timestamp
+
+    def get_elapsed_time(self) -> timedelta:
+        return self.end_time - self.start_time
+
+
+def detect_climbs(
+    segment: GarminSegment,
+    min_gain: float = 30.0,
+    min_grade: float = 3.0,
+    max_dip: float = 10.0,
+    resolution: float = 10.0,
+    smoothing: float = 50.0,
+) -> List[Climb]:
+    """
+    Climbs of at least min_gain meters at an average grade of at least
+    min_grade percent. Altitude is resampled every resolution meters of distance
+    and smoothed over smoothing meters first, and a climb only ends once the
+    road drops more than max_dip meters below its top.
+    """
+    altitudes = segment.get_record_array("altitude")
+    known = np.flatnonzero(~np.isnan(altitudes))
+    if len(known) < 2:
+        return []
+    distances = get_monotonic_distances(segment.get_record_array("distance"))[known]
+    altitudes = altitudes[known]
+
+    grid = np.arange(distances[0], distances[-1], resolution)
+    if len(grid) < 2:
+        return []
+    profile = np.interp(grid, distances, altitudes)
+    window = max(1, int(smoothing / resolution))
+    padded = np.pad(profile, (window // 2, window - 1 - window // 2), mode="edge")
+    profile = np.convolve(padded, np.ones(window) / window, mode="valid")
+
+    def to_record_index(grid_index: int) -> int:
+        position = min(np.searchsorted(distances, grid[grid_index]), len(known) - 1)
+        return int(known[position])
+
+    climbs = []
+
+    def add_climb(low: int, high: int) -> None:
+        # the longest climb ending at the top that is steep enough overall
+        gains = profile[high] - profile[low:high]
+        runs = grid[high] - grid[low:high]
+        steep_enough = (gains >= min_gain) & (gains >= runs * min_grade / 100)
+        if not np.any(steep_enough):
+            return
+        start = low + int(np.argmax(steep_enough))
+        climbs.append(
+            Climb(
+                to_record_index(start),
+                to_record_index(high),
+                float(grid[high] - grid[start]),
+                float(profile[high] - profile[start]),
+                segment,
+            )
+        )
+
+    # a single pass, keeping the lowest point since the last climb and the
+    # highest point after it
+    low = high = 0
+    for position in range(1, len(profile)):
+        if profile[position] >= profile[high]:
+            high = position
+        elif profile[high] - profile[position] > max_dip:
+            add_climb(low, high)
+            low = high = position
+        elif profile[position] < profile[low]:
+            low = high = position
+    add_climb(low, high)
+
+    return climbs
@@ -1,7 +1,6 @@
 import subprocess
 from datetime import datetime, timezone, timedelta
-from typing import Tuple, Dict, Any, List
-import ffmpeg
+from typing import Tuple, Dict, Any, List, Optional, Set
 import functools
 
 
@@ -35,10 +34,29 @@ class Video:
             total_seconds += self._get_duration(video_path)
         return total_seconds
 
+    @functools.cache
+    def get_chapters(self) -> List[Tuple[str, float, float]]:
+        """Path, start and end in seconds of every chapter in the video."""
+        chapters = []
+        chapter_start = 0.0
+        for video_path in self.video_paths:
+            chapter_end = chapter_start + self._get_duration(video_path).total_seconds()
+            chapters.append((video_path, chapter_start, chapter_end))
+            chapter_start = chapter_end
+        return chapters
+
+    @staticmethod
+    @functools.cache
+    def _probe(video_path: str) -> Dict[str, Any]:
+        # imported lazily so aligning a video doesn't pay for ffmpeg-python
+        import ffmpeg
+
+        return ffmpeg.probe(video_path)
+
     @staticmethod
     @functools.cache
     def _get_resolution(video_path) -> Tuple[int, int]:
-        probe = ffmpeg.probe(video_path)
+        probe = Video._probe(video_path)
         video_streams = [
             stream for stream in probe["streams"] if stream["codec_type"] == "video"
         ]
@@ -53,6 +71,67 @@ class Video:
         assert len(resolutions) == 1
         return next(resolution for resolution in resolutions)
 
+    @staticmethod
+    @functools.cache
+    def _get_audio_format(video_path: str) -> Optional[Tuple[str, int, int]]:
+        probe = Video._probe(video_path)
+        audio_streams = [
+            stream for stream in probe["streams"] if stream["codec_type"] == "audio"
+        ]
+        if len(audio_streams) == 0:
+            return None
+        audio_stream = audio_streams[0]
+        return (
+            audio_stream["codec_name"],
+            int(audio_stream["sample_rate"]),
+            int(audio_stream["channels"]),
+        )
+
+    @functools.cache
+    def get_audio_formats(self) -> Set[Optional[Tuple[str, int, int]]]:
+        """Distinct audio formats across chapters, empty if none have audio."""
+        audio_formats = set(
+            self._get_audio_format(video_path) for video_path in self.video_paths
+        )
+        return set() if audio_formats == {None} else audio_formats
+
+    @staticmethod
+    @functools.cache
+    def _get_audio_packet_duration(video_path: str) -> Optional[float]:
+        result = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-select_streams",
+                "a:0",
+                "-read_intervals",
+                "%+#1",
+                "-show_entries",
+                "packet=duration_time",
+                "-of",
+                "default=noprint_wrappers=1:nokey=1",
+                video_path,
+            ],
+            capture_output=True,
+        )
+        # some streams print no duration at all, or N/A
+        try:
+            return float(result.stdout.split()[0])
+        except (IndexError, ValueError):
+            return None
+
+    @functools.cache
+    def get_audio_packet_duration(self) -> Optional[float]:
+        """Longest audio packet across chapters, None if one isn't known."""
+        packet_durations = [
+            self._get_audio_packet_duration(video_path)
+            for video_path in self.video_paths
+        ]
+        if None in packet_durations:
+            return None
+        return max(packet_durations)
+
     def get_fps(self) -> float:
         fpss = set(self._get_fps(video_path) for video_path in self.video_paths)
         assert len(fpss) == 1